@@ -1,93 +1,379 @@
-from collections import deque
-import heapq
-
-def bfs_shortest(graph, start, goal):
-    if start == goal:
-        return [start]    
-    visited = {start}
-    q = deque([(start, [start])])    
-    while q:
-        node, path = q.popleft()        
-        for neigh, _, _ in graph.adj.get(node, []):
-            if neigh in visited:
-                continue
-            if neigh == goal:
-                return path + [neigh]
-            visited.add(neigh)
-            q.append((neigh, path + [neigh]))    
-    return None
-
-def dfs_path_safe(graph, start, goal, max_nodes=1000000, max_depth=5000):
-    if start == goal:
-        return [start]    
-    stack = [(start, [start])]
-    visited_nodes = 0    
-    while stack:
-        node, path = stack.pop()
-        visited_nodes += 1        
-        if visited_nodes > max_nodes:
-            return None        
-        if len(path) > max_depth:
-            continue        
-        if node == goal:
-            return path        
-        for neigh, _, _ in graph.adj.get(node, []):
-            if neigh in path:
-                continue
-            stack.append((neigh, path + [neigh]))    
-    return None
-
-def dijkstra(graph, start, goal):
-    dist = {start: 0.0}
-    prev = {}
-    pq = [(0.0, start)]
-    while pq:
-        d, node = heapq.heappop(pq)
-        if d > dist.get(node, float("inf")):
-            continue
-        if node == goal:
-            break
-        for neigh, w, _ in graph.adj.get(node, []):
-            nd = d + w
-            if nd < dist.get(neigh, float("inf")):
-                dist[neigh] = nd
-                prev[neigh] = node
-                heapq.heappush(pq, (nd, neigh))    
-    if goal not in prev and start != goal:
-        return None, float("inf")    
-    path = []
-    cur = goal
-    while cur != start:
-        path.append(cur)
-        cur = prev.get(cur)
-        if cur is None:
-            return None, float("inf")
-    path.append(start)
-    path.reverse()
-    return path, dist.get(goal, 0.0)
-
-def enumerate_paths_dfs(graph, start, goal, max_paths=50, max_depth=500, max_total_weight=None):
-    results = []
-    stack = [(start, [start], 0.0)]
-    iterations = 0    
-    while stack and len(results) < max_paths:
-        iterations += 1
-        if iterations > 5000000:
-            break        
-        node, path, tw = stack.pop()
-        if len(path) > max_depth:
-            continue
-        if node == goal:
-            results.append((path, tw))
-            if len(results) >= max_paths:
-                break
-            continue        
-        neighbors = graph.adj.get(node, [])        
-        for neigh, w, _ in neighbors:
-            if neigh in path:
-                continue            
-            new_tw = tw + w            
-            if max_total_weight and new_tw > max_total_weight:
-                continue            
-            stack.append((neigh, path + [neigh], new_tw))    
-    return results
\ No newline at end of file
+from collections import deque
+import heapq
+import math
+
+def _trace(prev, start, goal):
+    path = []
+    cur = goal
+    while cur != start:
+        path.append(cur)
+        cur = prev.get(cur)
+        if cur is None:
+            return None
+    path.append(start)
+    path.reverse()
+    return path
+
+# Search counters, added into a caller's stats dict (so repeated searches, like
+# Yen's spur searches, sum up): popped = queue/stack entries taken, settled =
+# nodes expanded, relaxed = edges looked at from them, pushes = heap pushes,
+# cap_hits = searches stopped by max_nodes / max_iterations.
+def _count(stats, **counts):
+    if stats is not None:
+        for k, v in counts.items():
+            stats[k] = stats.get(k, 0) + v
+
+def bfs_shortest(graph, start, goal, stats=None):
+    if start == goal:
+        return [start]
+    parent = {start: None}
+    q = deque([start])
+    popped = relaxed = 0
+    while q:
+        node = q.popleft()
+        popped += 1
+        neighbors = graph.adj.get(node, [])
+        relaxed += len(neighbors)
+        for neigh, _, _ in neighbors:
+            if neigh in parent:
+                continue
+            parent[neigh] = node
+            if neigh == goal:
+                _count(stats, popped=popped, settled=popped, relaxed=relaxed)
+                return _trace(parent, start, goal)
+            q.append(neigh)
+    _count(stats, popped=popped, settled=popped, relaxed=relaxed)
+    return None
+
+# The DFS variants keep one path plus an on-path set and backtrack, instead of
+# copying the path into every stack entry. Neighbours are walked in reverse so
+# the visiting order matches the old push-all-then-pop stack.
+def _unvisited(neighbors, on_path):
+    for neigh, _, _ in reversed(neighbors):
+        if neigh not in on_path:
+            yield neigh
+
+def dfs_path_safe(graph, start, goal, max_nodes=1000000, max_depth=5000, stats=None):
+    if start == goal:
+        return [start]
+    path = []
+    on_path = set()
+    stack = [iter((start,))]
+    visited_nodes = 0
+    settled = relaxed = 0
+    while stack:
+        node = next(stack[-1], None)
+        if node is None:
+            stack.pop()
+            if path:
+                on_path.discard(path.pop())
+            continue
+        visited_nodes += 1
+        if visited_nodes > max_nodes:
+            _count(stats, popped=visited_nodes - 1, settled=settled, relaxed=relaxed, cap_hits=1)
+            return None
+        path.append(node)
+        if len(path) > max_depth:
+            path.pop()
+            continue
+        if node == goal:
+            _count(stats, popped=visited_nodes, settled=settled, relaxed=relaxed)
+            return path
+        on_path.add(node)
+        neighbors = graph.adj.get(node, [])
+        settled += 1
+        relaxed += len(neighbors)
+        stack.append(_unvisited(neighbors, on_path))
+    _count(stats, popped=visited_nodes, settled=settled, relaxed=relaxed)
+    return None
+
+def dijkstra(graph, start, goal, stats=None):
+    dist = {start: 0.0}
+    prev = {}
+    pq = [(0.0, start)]
+    popped = settled = relaxed = 0
+    while pq:
+        d, node = heapq.heappop(pq)
+        popped += 1
+        if d > dist.get(node, float("inf")):
+            continue
+        settled += 1
+        if node == goal:
+            break
+        neighbors = graph.adj.get(node, [])
+        relaxed += len(neighbors)
+        for neigh, w, _ in neighbors:
+            nd = d + w
+            if nd < dist.get(neigh, float("inf")):
+                dist[neigh] = nd
+                prev[neigh] = node
+                heapq.heappush(pq, (nd, neigh))    
+    _count(stats, popped=popped, settled=settled, relaxed=relaxed, pushes=popped + len(pq))
+    if goal not in prev and start != goal:
+        return None, float("inf")    
+    path = _trace(prev, start, goal)
+    if path is None:
+        return None, float("inf")
+    return path, dist.get(goal, 0.0)
+
+def dijkstra_one_to_many(graph, start, targets, stats=None):
+    remaining = set(targets)
+    dist = {start: 0.0}
+    prev = {}
+    pq = [(0.0, start)]
+    popped = settled = relaxed = 0
+    while pq and remaining:
+        d, node = heapq.heappop(pq)
+        popped += 1
+        if d > dist.get(node, float("inf")):
+            continue
+        settled += 1
+        remaining.discard(node)
+        if not remaining:
+            break
+        neighbors = graph.adj.get(node, [])
+        relaxed += len(neighbors)
+        for neigh, w, _ in neighbors:
+            nd = d + w
+            if nd < dist.get(neigh, float("inf")):
+                dist[neigh] = nd
+                prev[neigh] = node
+                heapq.heappush(pq, (nd, neigh))
+    _count(stats, popped=popped, settled=settled, relaxed=relaxed, pushes=popped + len(pq))
+    return {t: (float("inf") if t in remaining else dist.get(t, float("inf"))) for t in targets}, prev
+
+# Every node whose cost from the nearest source is at most limit, as {node: cost}.
+# Nothing past the limit is ever pushed, so the search stops on its own.
+def dijkstra_within(graph, sources, limit, stats=None):
+    dist = {s: 0.0 for s in sources}
+    pq = [(0.0, s) for s in dist]
+    heapq.heapify(pq)
+    popped = settled = relaxed = 0
+    while pq:
+        d, node = heapq.heappop(pq)
+        popped += 1
+        if d > dist.get(node, float("inf")):
+            continue
+        settled += 1
+        neighbors = graph.adj.get(node, [])
+        relaxed += len(neighbors)
+        for neigh, w, _ in neighbors:
+            nd = d + w
+            if nd <= limit and nd < dist.get(neigh, float("inf")):
+                dist[neigh] = nd
+                heapq.heappush(pq, (nd, neigh))
+    _count(stats, popped=popped, settled=settled, relaxed=relaxed, pushes=popped)
+    return dist
+
+# Straight-line distance in the projected CRS times the graph's heuristic_scale
+# (lowest weight per unit of straight line) never exceeds the road length; the
+# small shrink absorbs rounding so the bound stays admissible. Weighted views
+# (travel time, profiles) also fold in their cheapest cost per metre.
+HEURISTIC_SLACK = 1.0 - 1e-9
+
+def _astar(graph, start, goal, scale, banned_nodes=(), banned_edges=(), stats=None, max_settled=None):
+    gx, gy = graph.node_coords[goal]
+    coords = graph.node_coords
+
+    def h(n):
+        x, y = coords[n]
+        return math.hypot(x - gx, y - gy) * scale
+
+    dist = {start: 0.0}
+    prev = {}
+    pq = [(h(start), 0.0, start)]
+    popped = settled = relaxed = capped = 0
+    while pq:
+        _, d, node = heapq.heappop(pq)
+        popped += 1
+        if d > dist.get(node, float("inf")):
+            continue
+        if max_settled is not None and settled >= max_settled:
+            capped = 1
+            break
+        settled += 1
+        if node == goal:
+            break
+        neighbors = graph.adj.get(node, [])
+        relaxed += len(neighbors)
+        for neigh, w, _ in neighbors:
+            if neigh in banned_nodes or (node, neigh) in banned_edges:
+                continue
+            nd = d + w
+            if nd < dist.get(neigh, float("inf")):
+                dist[neigh] = nd
+                prev[neigh] = node
+                heapq.heappush(pq, (nd + h(neigh), nd, neigh))
+    _count(stats, popped=popped, settled=settled, relaxed=relaxed, pushes=popped + len(pq), cap_hits=capped)
+    if capped or goal not in dist:
+        return None, float("inf")
+    path = _trace(prev, start, goal)
+    if path is None:
+        return None, float("inf")
+    return path, dist[goal]
+
+def astar(graph, start, goal, stats=None, heuristic_scale=1.0):
+    scale = heuristic_scale * getattr(graph, "heuristic_scale", 1.0) * HEURISTIC_SLACK
+    return _astar(graph, start, goal, scale, stats=stats)
+
+def bidirectional_dijkstra(graph, start, goal, stats=None):
+    if start == goal:
+        _count(stats, settled=0)
+        return [start], 0.0
+    radj = getattr(graph, "radj", graph.adj)
+    dist = ({start: 0.0}, {goal: 0.0})
+    prev = ({}, {})
+    pq = ([(0.0, start)], [(0.0, goal)])
+    adjs = (graph.adj, radj)
+    best, meet = float("inf"), None
+    popped = settled = relaxed = 0
+    while pq[0] and pq[1]:
+        # Stop once no path through an unsettled node can beat the best meeting
+        if pq[0][0][0] + pq[1][0][0] >= best:
+            break
+        side = 0 if pq[0][0][0] <= pq[1][0][0] else 1
+        d, node = heapq.heappop(pq[side])
+        popped += 1
+        if d > dist[side].get(node, float("inf")):
+            continue
+        settled += 1
+        other = dist[1 - side]
+        neighbors = adjs[side].get(node, [])
+        relaxed += len(neighbors)
+        for neigh, w, _ in neighbors:
+            nd = d + w
+            if nd < dist[side].get(neigh, float("inf")):
+                dist[side][neigh] = nd
+                prev[side][neigh] = node
+                heapq.heappush(pq[side], (nd, neigh))
+            if neigh in other and nd + other[neigh] < best:
+                best, meet = nd + other[neigh], neigh
+    _count(stats, popped=popped, settled=settled, relaxed=relaxed,
+           pushes=popped + len(pq[0]) + len(pq[1]))
+    if meet is None:
+        return None, float("inf")
+    head = _trace(prev[0], start, meet)
+    tail = _trace(prev[1], goal, meet)
+    if head is None or tail is None:
+        return None, float("inf")
+    tail.reverse()
+    return head + tail[1:], best
+
+def _unvisited_weighted(neighbors, on_path, tw, max_total_weight):
+    for neigh, w, _ in reversed(neighbors):
+        if neigh in on_path:
+            continue
+        new_tw = tw + w
+        if max_total_weight and new_tw > max_total_weight:
+            continue
+        yield neigh, new_tw
+
+def enumerate_paths_dfs(graph, start, goal, max_paths=50, max_depth=500, max_total_weight=None,
+                        max_iterations=5000000, stats=None):
+    results = []
+    path = []
+    on_path = set()
+    stack = [iter(((start, 0.0),))]
+    iterations = 0
+    settled = relaxed = cap_hits = 0
+    while stack and len(results) < max_paths:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            if path:
+                on_path.discard(path.pop())
+            continue
+        iterations += 1
+        if iterations > max_iterations:
+            iterations -= 1
+            cap_hits = 1
+            break
+        node, tw = entry
+        path.append(node)
+        if len(path) > max_depth or node == goal:
+            if node == goal and len(path) <= max_depth:
+                results.append((list(path), tw))
+            path.pop()
+            continue
+        on_path.add(node)
+        neighbors = graph.adj.get(node, [])
+        settled += 1
+        relaxed += len(neighbors)
+        stack.append(_unvisited_weighted(neighbors, on_path, tw, max_total_weight))
+    _count(stats, popped=iterations, settled=settled, relaxed=relaxed, cap_hits=cap_hits)
+    return results
+
+def _edge_weight(graph, u, v):
+    return min(w for neigh, w, _ in graph.adj.get(u, []) if neigh == v)
+
+def _overlap(edges, weights, other_edges, total):
+    if total <= 0:
+        return 1.0
+    shared = sum(w for e, w in zip(edges, weights) if e in other_edges)
+    return shared / total
+
+# Yen's k shortest loopless paths, returned as (path, weight) in increasing weight.
+# With max_overlap, a path sharing more than that fraction of its length with an
+# already returned path is skipped. At most max_candidates paths are generated
+# (k, or 4 * k when filtering), but each costs one A* spur search per node on
+# it, so long paths mean many large searches. max_settled caps the nodes settled
+# over all searches together: once it is spent no more spur searches run, the
+# candidates already found are still returned in order and stats["cap_hits"]
+# is set.
+def k_shortest_paths(graph, start, goal, k=10, max_overlap=None, max_candidates=None,
+                     max_total_weight=None, heuristic_scale=1.0, stats=None, max_settled=None):
+    if max_candidates is None:
+        max_candidates = k if max_overlap is None else 4 * k
+    scale = heuristic_scale * getattr(graph, "heuristic_scale", 1.0) * HEURISTIC_SLACK
+    spur_searches = 0
+    counts = {}
+
+    def budget():
+        return None if max_settled is None else max_settled - counts.get("settled", 0)
+
+    first, dist = _astar(graph, start, goal, scale, stats=counts, max_settled=budget())
+    found = []
+    results = []
+    accepted_edges = []
+    candidates = []
+    seen = set()
+    if first is not None and not (max_total_weight and dist > max_total_weight):
+        heapq.heappush(candidates, (dist, first))
+        seen.add(tuple(first))
+
+    while candidates and len(results) < k and len(found) < max_candidates:
+        weight, path = heapq.heappop(candidates)
+        if max_total_weight and weight > max_total_weight:
+            break
+        found.append(path)
+
+        edges = list(zip(path, path[1:]))
+        ew = [_edge_weight(graph, u, v) for u, v in edges]
+        if max_overlap is None or all(_overlap(edges, ew, other, weight) <= max_overlap
+                                      for other in accepted_edges):
+            results.append((path, weight))
+            accepted_edges.append(set(edges))
+        if len(results) >= k or len(found) >= max_candidates:
+            break
+
+        root_cost = 0.0
+        for i in range(len(path) - 1):
+            if counts.get("cap_hits"):
+                break
+            spur = path[i]
+            root = path[:i + 1]
+            banned_edges = {(p[i], p[i + 1]) for p in found if len(p) > i + 1 and p[:i + 1] == root}
+            banned_nodes = set(root[:-1])
+            tail, tail_cost = _astar(graph, spur, goal, scale, banned_nodes, banned_edges, stats=counts,
+                                     max_settled=budget())
+            spur_searches += 1
+            if tail is not None:
+                cand = root[:-1] + tail
+                key = tuple(cand)
+                if key not in seen:
+                    seen.add(key)
+                    heapq.heappush(candidates, (root_cost + tail_cost, cand))
+            root_cost += ew[i]
+
+    _count(stats, spur_searches=spur_searches, candidates=len(found), **counts)
+    return results
@@ -1,234 +1,885 @@
-from flask import Flask, request, jsonify, render_template
-from build_graph import build_graph_from_shp
-from algorithms import bfs_shortest, dfs_path_safe, dijkstra, enumerate_paths_dfs
-from pyproj import Transformer
-import os, logging
-
-logging.basicConfig(level=logging.INFO)
-log = logging.getLogger("routefinder")
-
-app = Flask(__name__, template_folder="templates", static_folder="static")
-SHP_PATH = os.environ.get("OSM_SHP", "mongolia-251026-free/gis_osm_roads_free_1.shp")
-log.info("Main: loading graph from %s", SHP_PATH)
-G, graph_crs = build_graph_from_shp(SHP_PATH)
-log.info("Main: graph loaded: nodes=%d adj_entries=%d", len(G.node_coords), sum(len(v) for v in G.adj.values()))
-
-transformer_to_graph = Transformer.from_crs("EPSG:4326", graph_crs.to_string(), always_xy=True)
-
-def nearest_node(graph, x, y):
-    best, best_d = None, float("inf")
-    for nid, (nx, ny) in graph.node_coords.items():
-        d = (nx - x)**2 + (ny - y)**2
-        if d < best_d:
-            best, best_d = nid, d
-    return best
-
-@app.route("/")
-def home():
-    return render_template("index.html")
-@app.route("/route")
-def route():
-    src = request.args.get("src")
-    dst = request.args.get("dst")
-    mode = request.args.get("mode", "shortest")
-    alg = (request.args.get("alg") or "").lower()
-    
-    try:
-        max_paths = int(request.args.get("max_paths", 50))
-    except:
-        max_paths = 50
-    try:
-        max_depth = int(request.args.get("max_depth", 500))
-    except:
-        max_depth = 500
-    max_weight_param = request.args.get("max_weight", None)
-    try:
-        max_weight = float(max_weight_param) if max_weight_param is not None else None
-    except:
-        max_weight = None
-
-    if not src or not dst:
-        return jsonify(error="src and dst required (lon,lat)"), 400
-    
-    try:
-        lon1, lat1 = map(float, src.split(","))
-        lon2, lat2 = map(float, dst.split(","))
-    except Exception as e:
-        return jsonify(error=f"bad src/dst format: {e}"), 400
-
-    try:
-        gx1, gy1 = transformer_to_graph.transform(lon1, lat1)
-        gx2, gy2 = transformer_to_graph.transform(lon2, lat2)
-    except Exception:
-        gx1, gy1, gx2, gy2 = lon1, lat1, lon2, lat2
-
-    s = nearest_node(G, gx1, gy1)
-    t = nearest_node(G, gx2, gy2)
-    
-    if s is None or t is None:
-        return jsonify(error="nearest node not found"), 400
-
-    note = None
-    
-    try:
-        if mode == "all":
-            if alg and alg != "dfs":
-                note = f"'{alg}' requested, using DFS enumeration for finding multiple paths."
-            if max_weight is None:
-                try:
-                    _, dist = dijkstra(G, s, t)
-                    if dist and dist != float("inf"):
-                        max_weight = dist * 1.5
-                except:
-                    pass
-            
-            paths = enumerate_paths_dfs(G, s, t,
-                                      max_paths=max_paths, 
-                                      max_depth=max_depth, 
-                                      max_total_weight=max_weight)
-            
-            out = []
-            for p_nodes, weight in paths:
-                out.append({"path": [G.node_lonlat[n] for n in p_nodes], "weight": weight})
-            
-            return jsonify({
-                "mode": "all", 
-                "algorithm": "DFS_enumerate", 
-                "paths": out, 
-                "count": len(out),
-                "note": note
-            })
-
-        if mode == "minsteps":
-            if alg in ("", "bfs"):
-                path_nodes = bfs_shortest(G, s, t)
-                used_alg = "BFS"
-            elif alg == "dijkstra":
-                path_nodes, _ = dijkstra(G, s, t)
-                used_alg = "Dijkstra"
-                note = "Using Dijkstra for weighted shortest path; BFS typically finds fewest edges."
-            elif alg == "dfs":
-                path_nodes = dfs_path_safe(G, s, t, max_nodes=1000000, max_depth=5000)
-                used_alg = "DFS"
-                note = "Using DFS; does not guarantee fewest edges."
-            else:
-                path_nodes = bfs_shortest(G, s, t)
-                used_alg = "BFS"
-                note = f"Unknown algorithm '{alg}' — defaulted to BFS."
-            
-            if not path_nodes:
-                return jsonify({"mode": "minsteps", "algorithm": used_alg, "error": "no path found", "note": note})
-            
-            coords = [G.node_lonlat[n] for n in path_nodes]
-            return jsonify({"mode": "minsteps", "algorithm": used_alg, "path": coords, "note": note})
-
-        if mode == "shortest":
-            if alg in ("", "dijkstra"):
-                path_nodes, dist = dijkstra(G, s, t)
-                used_alg = "Dijkstra"
-            elif alg == "bfs":
-                path_nodes = bfs_shortest(G, s, t)
-                dist = None
-                used_alg = "BFS"
-                note = "BFS minimizes edges, not necessarily distance."
-            elif alg == "dfs":
-                path_nodes = dfs_path_safe(G, s, t, max_nodes=1000000, max_depth=5000)
-                dist = None
-                used_alg = "DFS"
-                note = "DFS does not guarantee shortest distance."
-            else:
-                path_nodes, dist = dijkstra(G, s, t)
-                used_alg = "Dijkstra"
-                note = f"Unknown algorithm '{alg}' — defaulted to Dijkstra."
-            
-            if not path_nodes:
-                return jsonify({"mode": "shortest", "algorithm": used_alg, "error": "no path found", "note": note})
-            
-            coords = [G.node_lonlat[n] for n in path_nodes]
-            out = {"mode": "shortest", "algorithm": used_alg, "path": coords}
-            if dist is not None:
-                out["distance"] = round(dist, 3)
-            if note:
-                out["note"] = note
-            return jsonify(out)
-
-        return jsonify({"error": "unknown mode"})
-
-    except Exception as ex:
-        log.exception("Error processing route")
-        return jsonify(error=f"processing error: {str(ex)}"), 500
-
-@app.route("/compare")
-def compare():
-    src = request.args.get("src")
-    dst = request.args.get("dst")
-    alg = (request.args.get("alg") or "").lower()
-    
-    if not src or not dst:
-        return jsonify(error="src and dst required (lon,lat)"), 400
-    
-    try:
-        lon1, lat1 = map(float, src.split(","))
-        lon2, lat2 = map(float, dst.split(","))
-    except Exception as e:
-        return jsonify(error=f"bad src/dst format: {e}"), 400
-
-    gx1, gy1 = transformer_to_graph.transform(lon1, lat1)
-    gx2, gy2 = transformer_to_graph.transform(lon2, lat2)
-    s = nearest_node(G, gx1, gy1)
-    t = nearest_node(G, gx2, gy2)
-    
-    if s is None or t is None:
-        return jsonify(error="nearest node not found"), 400
-
-    results = []
-    
-    try:
-        path_nodes, dist = dijkstra(G, s, t)
-        if path_nodes:
-            coords = [G.node_lonlat[n] for n in path_nodes]
-            results.append({
-                "mode": "shortest",
-                "algorithm": "Dijkstra",
-                "path": coords,
-                "distance": round(dist, 3) if dist else None
-            })
-        else:
-            results.append({"mode": "shortest", "error": "no path found"})
-    except Exception as ex:
-        results.append({"mode": "shortest", "error": str(ex)})
-    
-    try:
-        path_nodes = bfs_shortest(G, s, t)
-        if path_nodes:
-            coords = [G.node_lonlat[n] for n in path_nodes]
-            results.append({
-                "mode": "minsteps",
-                "algorithm": "BFS",
-                "path": coords
-            })
-        else:
-            results.append({"mode": "minsteps", "error": "no path found"})
-    except Exception as ex:
-        results.append({"mode": "minsteps", "error": str(ex)})
-    
-    try:
-        _, dist = dijkstra(G, s, t)
-        max_weight = dist * 1.5 if dist and dist != float("inf") else None
-        paths = enumerate_paths_dfs(G, s, t, max_paths=20, max_depth=300, max_total_weight=max_weight)
-        out = []
-        for p_nodes, weight in paths:
-            out.append({"path": [G.node_lonlat[n] for n in p_nodes], "weight": weight})
-        results.append({
-            "mode": "all",
-            "algorithm": "DFS_enumerate",
-            "paths": out,
-            "count": len(out)
-        })
-    except Exception as ex:
-        results.append({"mode": "all", "error": str(ex)})
-    
-    return jsonify(results)
-
-if __name__ == "__main__":
-    app.run(debug=True, port=5000, threaded=True)
\ No newline at end of file
+from flask import Flask, Response, g, request, jsonify, render_template
+from graph_cache import load_or_build
+from build_graph import crs_scale, crs_scales
+from contraction import ContractionHierarchy, default_ch_path
+import route_cache
+import profiles
+import metrics
+from patches import PatchedGraph, PatchError, PatchLog, PatchSet, resolve
+from matrix import MatrixPool, default_workers, distance_matrix
+import isochrone
+from encoding import encode_polyline, delta_encode, douglas_peucker
+from algorithms import (bfs_shortest, dfs_path_safe, dijkstra, astar, bidirectional_dijkstra,
+                        enumerate_paths_dfs, k_shortest_paths)
+import numpy as np
+from pyproj import Transformer
+from pyproj.exceptions import ProjError
+from collections import namedtuple
+from functools import partial
+import os, json, logging, threading
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("routefinder")
+
+app = Flask(__name__, template_folder="templates", static_folder="static")
+SHP_PATH = os.environ.get("OSM_SHP", "mongolia-251026-free/gis_osm_roads_free_1.shp")
+GRAPH_CACHE = os.environ.get("OSM_GRAPH_CACHE")
+HASH_SOURCE = os.environ.get("OSM_CACHE_HASH") == "1"
+SIMPLIFY = os.environ.get("OSM_SIMPLIFY") == "1"
+log.info("Main: loading graph from %s", SHP_PATH)
+G, graph_crs, GRAPH_KEY = load_or_build(SHP_PATH, cache_path=GRAPH_CACHE, hash_source=HASH_SOURCE,
+                                        simplify=SIMPLIFY)
+log.info("Main: graph loaded: nodes=%d adj_entries=%d simplified=%s", G.num_nodes, G.num_edges, SIMPLIFY)
+
+CH_PATH = os.environ.get("OSM_CH") or default_ch_path(SHP_PATH, SIMPLIFY)
+CH = ContractionHierarchy.load(CH_PATH, GRAPH_KEY)
+if CH is None:
+    log.info("Main: no contraction hierarchy at %s (run: python contraction.py build)", CH_PATH)
+else:
+    log.info("Main: contraction hierarchy loaded from %s", CH_PATH)
+
+PROFILES = profiles.load_profiles()
+
+transformer_to_graph = Transformer.from_crs("EPSG:4326", graph_crs.to_string(), always_xy=True)
+
+# Keyed on snapped node ids, so nearby clicks share entries
+ROUTE_CACHE = route_cache.from_env(os.path.splitext(SHP_PATH)[0] + ".routes.sqlite",
+                                   namespace=GRAPH_KEY[:16] + profiles.fingerprint(PROFILES)[:8])
+
+MATRIX_MAX_CELLS = int(os.environ.get("MATRIX_MAX_CELLS", 250000))
+# Forked on the first /matrix request (MATRIX_WORKERS > 1 only); only the unpatched
+# graph (and its weighted views) run there, patched graphs are searched in-process
+MATRIX_POOL = MatrixPool(G, default_workers())
+
+# Per process: with several gunicorn workers each one is scraped/profiled on its own
+METRICS = metrics.Metrics()
+METRICS.describe("requests_total", "counter", "HTTP requests by endpoint and status")
+METRICS.describe("request_seconds", "histogram", "Request wall time by endpoint")
+METRICS.describe("phase_seconds", "histogram", "Time per request phase (transform, snap, cache, search, encode, serialize)")
+METRICS.describe("searches_total", "counter", "Graph searches by algorithm")
+for _name, _text in metrics.SEARCH_COUNTERS.items():
+    METRICS.describe(f"search_{_name}_total", "counter", _text + ", by algorithm")
+PROFILER = metrics.SamplingProfiler(float(os.environ.get("PROFILE_RATE", 0)))
+
+# Keyed on snapped sources, limits and the patch version, so a patch never serves a stale area
+ISOCHRONE_CACHE = route_cache.LRUCache(max_entries=int(os.environ.get("ISOCHRONE_CACHE_ENTRIES", 256)),
+                                       max_bytes=int(float(os.environ.get("ISOCHRONE_CACHE_MB", 32)) * 1024 * 1024))
+ISOCHRONE_MAX_LIMITS = 10
+
+# Nodes settled by all of one request's Yen spur searches together; past it the
+# candidates found so far are returned and the result says "capped"
+KSP_MAX_SETTLED = int(os.environ.get("KSP_MAX_SETTLED", 200000))
+
+# /compare shows a few alternatives next to every engine, so it gets a smaller budget
+COMPARE_KSP_PATHS = 3
+COMPARE_KSP_OVERLAP = 0.8
+COMPARE_KSP_MAX_SETTLED = int(os.environ.get("COMPARE_KSP_MAX_SETTLED", 50000))
+
+def ch_query(ch, graph, s, t, stats=None):
+    return ch.query(s, t, stats=stats)
+
+SHORTEST_ENGINES = {
+    "dijkstra": ("Dijkstra", dijkstra),
+    "astar": ("A*", astar),
+    "bidijkstra": ("Bidirectional Dijkstra", bidirectional_dijkstra),
+}
+
+# Everything a request reads from the graph. Patches build a new State and swap
+# it in with one assignment; handlers take STATE once, so a request never sees
+# half of a patch.
+State = namedtuple("State", "graph weighting ch engines patches version")
+
+def make_state(graph, ch, patches, version):
+    engines = dict(SHORTEST_ENGINES)
+    if ch is not None:
+        engines["ch"] = ("CH", partial(ch_query, ch))
+    return State(graph, profiles.Weighting(graph, PROFILES), ch, engines, patches, version)
+
+STATE = make_state(G, CH, PatchSet(G.num_nodes), 0)
+PATCH_LOCK = threading.RLock()
+PATCH_PATH = os.environ.get("OSM_PATCHES", os.path.splitext(SHP_PATH)[0] + ".patches.jsonl")
+PATCH_LOG = PatchLog(PATCH_PATH, GRAPH_KEY) if PATCH_PATH.lower() != "off" else None
+
+GEOMETRY_FORMATS = ("json", "polyline", "polyline6", "delta")
+
+def encode_path(nodes, fmt="json", simplify=None, graph=None):
+    graph = graph or STATE.graph
+    nodes = graph.expand_path(nodes)
+    if simplify and len(nodes) > 2:
+        # simplify is in ground metres, the coordinates in graph CRS units
+        keep = douglas_peucker(graph.coords[nodes], simplify * crs_scale(graph_crs, graph.lonlat[nodes]))
+        nodes = [nodes[i] for i in keep]
+    lonlat = graph.lonlat[nodes].tolist()
+    if fmt == "polyline":
+        return encode_polyline(lonlat, 5)
+    if fmt == "polyline6":
+        return encode_polyline(lonlat, 6)
+    if fmt == "delta":
+        return delta_encode(lonlat)
+    return lonlat
+
+def geometry_args():
+    fmt = (request.args.get("format") or "json").lower()
+    if fmt not in GEOMETRY_FORMATS:
+        raise ValueError(f"unknown format '{fmt}' (one of {', '.join(GEOMETRY_FORMATS)})")
+    simplify = request.args.get("simplify")
+    return fmt, float(simplify) if simplify else None
+
+def weight_arg():
+    weight = (request.args.get("weight") or "distance").lower()
+    if weight not in PROFILES:
+        raise ValueError(f"unknown weight '{weight}' (one of {', '.join(sorted(PROFILES))})")
+    return weight
+
+def result_bbox(graph, result):
+    nodes = list(result.get("path") or [])
+    for p in result.get("paths") or []:
+        nodes.extend(p["path"])
+    if not nodes:
+        return None
+    xy = graph.coords[graph.expand_path(nodes)]
+    (x0, y0), (x1, y1) = xy.min(axis=0).tolist(), xy.max(axis=0).tolist()
+    return (x0, y0, x1, y1)
+
+def nearest_node(graph, x, y):
+    index = getattr(graph, "index", None)
+    if index is not None:
+        return index.nearest(x, y)
+    best, best_d = None, float("inf")
+    for nid, (nx, ny) in graph.node_coords.items():
+        d = (nx - x)**2 + (ny - y)**2
+        if d < best_d:
+            best, best_d = nid, d
+    return best
+
+def parse_points(text):
+    pts = []
+    for pair in text.split(";"):
+        if pair.strip():
+            lon, lat = map(float, pair.split(","))
+            pts.append((lon, lat))
+    return pts
+
+@app.before_request
+def start_timing():
+    g.timing = metrics.Timing()
+    g.profile = PROFILER.start()
+
+@app.after_request
+def record_timing(response):
+    endpoint = request.endpoint or "unknown"
+    METRICS.inc("requests_total", endpoint=endpoint, status=response.status_code)
+    tm = g.get("timing")
+    if tm is not None:
+        METRICS.observe("request_seconds", tm.elapsed(), endpoint=endpoint)
+        for phase, seconds in tm.phases.items():
+            METRICS.observe("phase_seconds", seconds, endpoint=endpoint, phase=phase)
+    return response
+
+@app.teardown_request
+def stop_profile(exc=None):
+    prof = g.pop("profile", None)
+    if prof is not None:
+        PROFILER.stop(prof)
+
+def want_timing():
+    return request.args.get("timing", "0") in ("1", "true")
+
+@app.route("/")
+def home():
+    return render_template("index.html")
+@app.route("/route")
+def route():
+    src = request.args.get("src")
+    dst = request.args.get("dst")
+    mode = request.args.get("mode", "shortest")
+    alg = (request.args.get("alg") or "").lower()
+    
+    try:
+        max_paths = int(request.args.get("max_paths", 50))
+    except ValueError:
+        max_paths = 50
+    try:
+        max_depth = int(request.args.get("max_depth", 500))
+    except ValueError:
+        max_depth = 500
+    max_weight_param = request.args.get("max_weight", None)
+    try:
+        max_weight = float(max_weight_param) if max_weight_param is not None else None
+    except ValueError:
+        max_weight = None
+    overlap_param = request.args.get("overlap", None)
+    try:
+        max_overlap = float(overlap_param) if overlap_param is not None else None
+    except ValueError:
+        max_overlap = None
+
+    if not src or not dst:
+        return jsonify(error="src and dst required (lon,lat)"), 400
+    
+    try:
+        lon1, lat1 = map(float, src.split(","))
+        lon2, lat2 = map(float, dst.split(","))
+    except Exception as e:
+        return jsonify(error=f"bad src/dst format: {e}"), 400
+
+    tm = g.timing
+    try:
+        with tm.phase("transform"):
+            gx1, gy1 = transformer_to_graph.transform(lon1, lat1, errcheck=True)
+            gx2, gy2 = transformer_to_graph.transform(lon2, lat2, errcheck=True)
+    except ProjError as e:
+        return jsonify(error=f"cannot project src/dst: {e}"), 400
+
+    with tm.phase("patches"):
+        sync_patches()
+    st = STATE
+    with tm.phase("snap"):
+        s = nearest_node(st.graph, gx1, gy1)
+        t = nearest_node(st.graph, gx2, gy2)
+    
+    if s is None or t is None:
+        return jsonify(error="nearest node not found"), 400
+
+    try:
+        fmt, simplify = geometry_args()
+        weight = weight_arg()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    stream = request.args.get("stream", "0") in ("1", "true")
+
+    key = (s, t, mode, alg, max_paths, max_depth, max_weight, max_overlap, weight)
+    try:
+        with tm.phase("cache"):
+            result = ROUTE_CACHE.get(key)
+        if result is None:
+            stats = {}
+            with tm.phase("search"):
+                result = compute_route(st, s, t, mode, alg, max_paths, max_depth, max_weight, max_overlap,
+                                       weight, stats)
+            METRICS.record_search(result.get("algorithm", "none"), stats)
+            # Skip the cache if a patch landed while this was computed
+            if STATE is st:
+                with tm.phase("cache"):
+                    cache_route(key, result, result_bbox(st.graph, result))
+        if stream and "paths" in result:
+            return Response(stream_result(result, fmt, simplify, st), mimetype="application/x-ndjson")
+        with tm.phase("encode"):
+            out = render_result(result, fmt, simplify, st)
+        # jsonify itself is only in /metrics, it runs after this is filled in
+        if want_timing():
+            out["timing"] = tm.as_dict()
+        with tm.phase("serialize"):
+            return jsonify(out)
+    except Exception as ex:
+        log.exception("Error processing route")
+        return jsonify(error=f"processing error: {str(ex)}"), 500
+
+def journal_moved():
+    return PATCH_LOG is not None and PATCH_LOG.changed()
+
+def cache_route(key, result, bbox):
+    # STATE only shows the patches this worker has synced. Another worker may have
+    # journalled one (and cleared the shared entries it affects) since, so the
+    # shared file is only written while the journal is where it was, and the
+    # entry is taken back if a patch lands during the write.
+    ROUTE_CACHE.put(key, result, bbox=bbox, shared=not journal_moved())
+    if journal_moved():
+        ROUTE_CACHE.discard_shared(key)
+
+def render_result(result, fmt="json", simplify=None, st=None):
+    out = dict(result)
+    graph = (st or STATE).weighting.view(result.get("weight", "distance"))
+    if "path" in out:
+        out["path"] = encode_path(out["path"], fmt, simplify, graph)
+    if "paths" in out:
+        out["paths"] = [{"path": encode_path(p["path"], fmt, simplify, graph), "weight": p["weight"]}
+                        for p in out["paths"]]
+    if fmt != "json":
+        out["format"] = fmt
+    return out
+
+def stream_result(result, fmt="json", simplify=None, st=None):
+    # One JSON object per line: a header, then each path as soon as it is encoded
+    head = {k: v for k, v in result.items() if k != "paths"}
+    head["format"] = fmt
+    yield json.dumps(head) + "\n"
+    graph = (st or STATE).weighting.view(result.get("weight", "distance"))
+    for p in result["paths"]:
+        yield json.dumps({"path": encode_path(p["path"], fmt, simplify, graph), "weight": p["weight"]}) + "\n"
+
+def compute_route(st, s, t, mode, alg, max_paths, max_depth, max_weight, max_overlap, weight="distance",
+                  stats=None):
+    result = _compute_route(st, st.weighting.view(weight), s, t, mode, alg,
+                            max_paths, max_depth, max_weight, max_overlap, {} if stats is None else stats)
+    if weight != "distance":
+        result["weight"] = weight
+    return result
+
+def _compute_route(st, graph, s, t, mode, alg, max_paths, max_depth, max_weight, max_overlap, stats):
+    note = None
+    if mode == "all" and alg == "ksp":
+        paths = k_shortest_paths(graph, s, t, k=max_paths, max_overlap=max_overlap,
+                                 max_total_weight=max_weight, stats=stats, max_settled=KSP_MAX_SETTLED)
+        out = []
+        for p_nodes, weight in paths:
+            out.append({"path": p_nodes, "weight": weight})
+        return {
+            "mode": "all",
+            "algorithm": "Yen_KSP",
+            "paths": out,
+            "count": len(out),
+            "settled": stats["settled"],
+            "spur_searches": stats["spur_searches"],
+            "capped": bool(stats.get("cap_hits"))
+        }
+
+    if mode == "all":
+        if alg and alg != "dfs":
+            note = f"'{alg}' requested, using DFS enumeration for finding multiple paths."
+        if max_weight is None:
+            bound_stats = {}
+            _, dist = dijkstra(graph, s, t, stats=bound_stats)
+            METRICS.record_search("Dijkstra", bound_stats)
+            if dist and dist != float("inf"):
+                max_weight = dist * 1.5
+        
+        paths = enumerate_paths_dfs(graph, s, t,
+                                  max_paths=max_paths, 
+                                  max_depth=max_depth, 
+                                  max_total_weight=max_weight,
+                                  stats=stats)
+        
+        out = []
+        for p_nodes, weight in paths:
+            out.append({"path": p_nodes, "weight": weight})
+        
+        return {
+            "mode": "all", 
+            "algorithm": "DFS_enumerate", 
+            "paths": out, 
+            "count": len(out),
+            "note": note
+        }
+
+    if mode == "minsteps":
+        if alg in ("", "bfs"):
+            path_nodes = bfs_shortest(graph, s, t, stats=stats)
+            used_alg = "BFS"
+        elif alg == "dijkstra":
+            path_nodes, _ = dijkstra(graph, s, t, stats=stats)
+            used_alg = "Dijkstra"
+            note = "Using Dijkstra for weighted shortest path; BFS typically finds fewest edges."
+        elif alg == "dfs":
+            path_nodes = dfs_path_safe(graph, s, t, max_nodes=1000000, max_depth=5000, stats=stats)
+            used_alg = "DFS"
+            note = "Using DFS; does not guarantee fewest edges."
+        else:
+            path_nodes = bfs_shortest(graph, s, t, stats=stats)
+            used_alg = "BFS"
+            note = f"Unknown algorithm '{alg}' — defaulted to BFS."
+        
+        if not path_nodes:
+            return {"mode": "minsteps", "algorithm": used_alg, "error": "no path found", "note": note}
+        
+        return {"mode": "minsteps", "algorithm": used_alg, "path": path_nodes, "note": note}
+
+    if mode == "shortest":
+        if alg == "ch" and st.ch is None:
+            path_nodes, dist = dijkstra(graph, s, t, stats=stats)
+            used_alg = "Dijkstra"
+            if st.patches.active:
+                note = "Contraction hierarchy is off while patches are applied — defaulted to Dijkstra."
+            else:
+                note = "Contraction hierarchy not built — defaulted to Dijkstra."
+        elif alg == "ch" and graph is not st.graph:
+            path_nodes, dist = dijkstra(graph, s, t, stats=stats)
+            used_alg = "Dijkstra"
+            note = "Contraction hierarchy only covers weight=distance — defaulted to Dijkstra."
+        elif alg in ("", "dijkstra", "astar", "bidijkstra", "ch"):
+            used_alg, engine = st.engines[alg or "dijkstra"]
+            path_nodes, dist = engine(graph, s, t, stats=stats)
+        elif alg == "bfs":
+            path_nodes = bfs_shortest(graph, s, t, stats=stats)
+            dist = None
+            used_alg = "BFS"
+            note = "BFS minimizes edges, not necessarily distance."
+        elif alg == "dfs":
+            path_nodes = dfs_path_safe(graph, s, t, max_nodes=1000000, max_depth=5000, stats=stats)
+            dist = None
+            used_alg = "DFS"
+            note = "DFS does not guarantee shortest distance."
+        else:
+            path_nodes, dist = dijkstra(graph, s, t, stats=stats)
+            used_alg = "Dijkstra"
+            note = f"Unknown algorithm '{alg}' — defaulted to Dijkstra."
+        
+        if not path_nodes:
+            return {"mode": "shortest", "algorithm": used_alg, "error": "no path found", "note": note}
+        
+        out = {"mode": "shortest", "algorithm": used_alg, "path": path_nodes}
+        if graph is not st.graph:
+            if dist is not None:
+                out["cost"] = round(dist, 3)
+            out["distance"] = round(graph.path_length(path_nodes), 3)
+        elif dist is not None:
+            out["distance"] = round(dist, 3)
+        if "settled" in stats:
+            out["settled"] = stats["settled"]
+        if note:
+            out["note"] = note
+        return out
+
+    return {"error": "unknown mode"}
+
+@app.route("/compare")
+def compare():
+    src = request.args.get("src")
+    dst = request.args.get("dst")
+    alg = (request.args.get("alg") or "").lower()
+    
+    if not src or not dst:
+        return jsonify(error="src and dst required (lon,lat)"), 400
+    
+    try:
+        lon1, lat1 = map(float, src.split(","))
+        lon2, lat2 = map(float, dst.split(","))
+    except Exception as e:
+        return jsonify(error=f"bad src/dst format: {e}"), 400
+
+    tm = g.timing
+    try:
+        with tm.phase("transform"):
+            gx1, gy1 = transformer_to_graph.transform(lon1, lat1, errcheck=True)
+            gx2, gy2 = transformer_to_graph.transform(lon2, lat2, errcheck=True)
+    except ProjError as e:
+        return jsonify(error=f"cannot project src/dst: {e}"), 400
+
+    with tm.phase("patches"):
+        sync_patches()
+    st = STATE
+    with tm.phase("snap"):
+        s = nearest_node(st.graph, gx1, gy1)
+        t = nearest_node(st.graph, gx2, gy2)
+    
+    if s is None or t is None:
+        return jsonify(error="nearest node not found"), 400
+    try:
+        fmt, simplify = geometry_args()
+        weight = weight_arg()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    graph = st.weighting.view(weight)
+
+    results = []
+    
+    for key in ("dijkstra", "astar", "bidijkstra", "ch"):
+        if key not in st.engines or (key == "ch" and graph is not st.graph):
+            continue
+        name, engine = st.engines[key]
+        try:
+            stats = {}
+            with tm.phase("search"):
+                path_nodes, dist = engine(graph, s, t, stats=stats)
+            METRICS.record_search(name, stats)
+            if path_nodes:
+                with tm.phase("encode"):
+                    entry = {
+                        "mode": "shortest",
+                        "algorithm": name,
+                        "path": encode_path(path_nodes, fmt, simplify, graph),
+                        "distance": round(dist, 3) if dist else None,
+                        "settled": stats.get("settled")
+                    }
+                    if graph is not st.graph:
+                        entry["weight"] = weight
+                        entry["cost"] = entry["distance"]
+                        entry["distance"] = round(graph.path_length(path_nodes), 3)
+                results.append(entry)
+            else:
+                results.append({"mode": "shortest", "algorithm": name, "error": "no path found"})
+        except Exception as ex:
+            log.exception("Error in compare: %s", name)
+            results.append({"mode": "shortest", "algorithm": name, "error": str(ex)})
+    
+    try:
+        stats = {}
+        with tm.phase("search"):
+            path_nodes = bfs_shortest(graph, s, t, stats=stats)
+        METRICS.record_search("BFS", stats)
+        if path_nodes:
+            with tm.phase("encode"):
+                results.append({
+                    "mode": "minsteps",
+                    "algorithm": "BFS",
+                    "path": encode_path(path_nodes, fmt, simplify, graph)
+                })
+        else:
+            results.append({"mode": "minsteps", "error": "no path found"})
+    except Exception as ex:
+        log.exception("Error in compare: BFS")
+        results.append({"mode": "minsteps", "error": str(ex)})
+    
+    try:
+        stats = {}
+        with tm.phase("search"):
+            paths = k_shortest_paths(graph, s, t, k=COMPARE_KSP_PATHS, max_overlap=COMPARE_KSP_OVERLAP,
+                                     stats=stats, max_settled=COMPARE_KSP_MAX_SETTLED)
+        METRICS.record_search("Yen_KSP", stats)
+        with tm.phase("encode"):
+            out = [{"path": encode_path(p_nodes, fmt, simplify, graph), "weight": cost}
+                   for p_nodes, cost in paths]
+        results.append({
+            "mode": "all",
+            "algorithm": "Yen_KSP",
+            "paths": out,
+            "count": len(out),
+            "settled": stats["settled"],
+            "capped": bool(stats.get("cap_hits"))
+        })
+    except Exception as ex:
+        log.exception("Error in compare: Yen_KSP")
+        results.append({"mode": "all", "error": str(ex)})
+    
+    # The plain response is the list; timing=1 wraps it so the phases can go alongside
+    out = {"results": results, "timing": tm.as_dict()} if want_timing() else results
+    with tm.phase("serialize"):
+        return jsonify(out)
+
+@app.route("/snap", methods=["GET", "POST"])
+def snap():
+    body = request.get_json(silent=True) or {}
+    try:
+        if "points" in body:
+            pts = [(float(p[0]), float(p[1])) for p in body["points"]]
+        else:
+            pts = parse_points(request.args.get("pts", ""))
+        k = body.get("k", request.args.get("k"))
+        k = max(int(k), 1) if k is not None else None
+        radius = body.get("radius", request.args.get("radius"))
+        radius = float(radius) if radius is not None else None
+    except (TypeError, ValueError, IndexError) as e:
+        return jsonify(error=f"bad points: {e}"), 400
+    if not pts:
+        return jsonify(error="pts required (lon,lat;lon,lat;...)"), 400
+    sync_patches()
+    graph = STATE.graph
+    if graph.index is None:
+        return jsonify(error="spatial index not loaded"), 500
+
+    try:
+        xs, ys = transformer_to_graph.transform([p[0] for p in pts], [p[1] for p in pts], errcheck=True)
+    except ProjError as e:
+        return jsonify(error=f"cannot project points: {e}"), 400
+    # radius and dist are ground metres; the index works in graph CRS units
+    units = crs_scales(graph_crs, np.array(pts, dtype=np.float64))
+    out = []
+    for x, y, u in zip(xs, ys, units.tolist()):
+        if radius is not None:
+            found = graph.index.within(x, y, radius * u)[:k]
+        else:
+            found = graph.index.knearest(x, y, k or 1)
+        out.append([{"node": n, "lonlat": graph.node_lonlat[n], "dist": round(d / u, 3)} for n, d in found])
+    return jsonify({"snapped": out, "count": len(out)})
+
+def snap_points(graph, pts):
+    # Raises ProjError for points outside the graph CRS
+    xs, ys = transformer_to_graph.transform([p[0] for p in pts], [p[1] for p in pts], errcheck=True)
+    return graph.index.nearest_many(xs, ys)
+
+@app.route("/matrix", methods=["GET", "POST"])
+def matrix():
+    body = request.get_json(silent=True) or {}
+    try:
+        if "sources" in body:
+            sources = [(float(p[0]), float(p[1])) for p in body["sources"]]
+            targets = [(float(p[0]), float(p[1])) for p in body.get("targets") or []]
+            geometry = bool(body.get("geometry", False))
+        else:
+            sources = parse_points(request.args.get("sources", ""))
+            targets = parse_points(request.args.get("targets", ""))
+            geometry = request.args.get("geometry", "0") in ("1", "true")
+    except (TypeError, ValueError, IndexError) as e:
+        return jsonify(error=f"bad points: {e}"), 400
+    if not sources:
+        return jsonify(error="sources required (lon,lat;lon,lat;...)"), 400
+    try:
+        fmt, simplify = geometry_args()
+        weight = weight_arg()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    sync_patches()
+    st = STATE
+    graph = st.weighting.view(weight)
+    if not targets:
+        targets = sources
+    if len(sources) * len(targets) > MATRIX_MAX_CELLS:
+        return jsonify(error=f"matrix too large (max {MATRIX_MAX_CELLS} cells)"), 400
+
+    tm = g.timing
+    try:
+        with tm.phase("snap"):
+            src_nodes = snap_points(st.graph, sources)
+            dst_nodes = snap_points(st.graph, targets)
+    except ProjError as e:
+        return jsonify(error=f"cannot project points: {e}"), 400
+    try:
+        with tm.phase("search"):
+            distances, paths, settled = distance_matrix(graph, src_nodes, dst_nodes, MATRIX_POOL, with_paths=geometry)
+    except Exception as ex:
+        log.exception("Error processing matrix")
+        return jsonify(error=f"processing error: {str(ex)}"), 500
+    METRICS.record_search("Dijkstra_one_to_many", {"settled": settled})
+
+    with tm.phase("encode"):
+        out = {
+            "sources": [{"node": n, "lonlat": st.graph.node_lonlat[n]} for n in src_nodes],
+            "targets": [{"node": n, "lonlat": st.graph.node_lonlat[n]} for n in dst_nodes],
+            "distances": [[round(d, 1) if d != float("inf") else None for d in row] for row in distances],
+            "settled": settled,
+        }
+        if graph is not st.graph:
+            out["weight"] = weight
+        if geometry:
+            out["paths"] = [[encode_path(p, fmt, simplify, graph) if p else None for p in row] for row in paths]
+    if want_timing():
+        out["timing"] = tm.as_dict()
+    with tm.phase("serialize"):
+        return jsonify(out)
+
+def parse_limits(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [float(v) for v in value]
+    return [float(v) for v in str(value).split(",") if v.strip()]
+
+# /isochrone?src=lon,lat[;lon,lat...]&km=1,2,5  or  &minutes=5,10,15 (weight=time by default)
+# shape=hull (concave, ratio=0..1, 1 is convex) or shape=grid (cell=metres); also POST with
+# {"sources": [[lon, lat], ...], "km": [...], ...}
+@app.route("/isochrone", methods=["GET", "POST"])
+def isochrone_route():
+    body = request.get_json(silent=True) or {}
+    arg = lambda name, default=None: body.get(name, request.args.get(name, default))
+    try:
+        if "sources" in body:
+            sources = [(float(p[0]), float(p[1])) for p in body["sources"]]
+        else:
+            sources = parse_points(request.args.get("src", ""))
+        km = arg("km")
+        minutes = arg("minutes")
+        limits = sorted(set(parse_limits(km if km is not None else minutes)))
+        shape = str(arg("shape", "hull")).lower()
+        cell = float(arg("cell", 250))
+        ratio = float(arg("ratio", 0.3))
+        simplify = arg("simplify")
+        simplify = float(simplify) if simplify else None
+    except (TypeError, ValueError, IndexError) as e:
+        return jsonify(error=f"bad isochrone request: {e}"), 400
+    if not sources:
+        return jsonify(error="src required (lon,lat;lon,lat;...)"), 400
+    if (km is None) == (minutes is None):
+        return jsonify(error="give either km or minutes (comma-separated thresholds)"), 400
+    if not limits or limits[0] <= 0 or len(limits) > ISOCHRONE_MAX_LIMITS:
+        return jsonify(error=f"1 to {ISOCHRONE_MAX_LIMITS} thresholds > 0 required"), 400
+    if shape not in isochrone.SHAPES:
+        return jsonify(error=f"unknown shape '{shape}' (one of {', '.join(isochrone.SHAPES)})"), 400
+    if cell <= 0 or not 0 <= ratio <= 1:
+        return jsonify(error="cell must be > 0 and ratio between 0 and 1"), 400
+
+    unit = "km" if km is not None else "minutes"
+    weight = str(arg("weight", "distance" if unit == "km" else "time")).lower()
+    if weight not in PROFILES:
+        return jsonify(error=f"unknown weight '{weight}' (one of {', '.join(sorted(PROFILES))})"), 400
+    metric = PROFILES[weight].get("metric", "distance")
+    if metric != ("distance" if unit == "km" else "time"):
+        return jsonify(error=f"{unit} needs a {'distance' if unit == 'km' else 'time'} weight, '{weight}' is {metric}"), 400
+    scale = 1000.0 if unit == "km" else 60.0
+
+    tm = g.timing
+    with tm.phase("patches"):
+        sync_patches()
+    st = STATE
+    try:
+        with tm.phase("snap"):
+            nodes = sorted(set(snap_points(st.graph, sources)))
+    except ProjError as e:
+        return jsonify(error=f"cannot project src: {e}"), 400
+    key = (st.version, tuple(nodes), tuple(limits), unit, weight, shape, cell, ratio, simplify)
+    with tm.phase("cache"):
+        out = ISOCHRONE_CACHE.get(key)
+    if out is None:
+        graph = st.weighting.view(weight)
+        stats = {}
+        with tm.phase("search"):
+            reached, costs = isochrone.reach(graph, nodes, [v * scale for v in limits], stats)
+        METRICS.record_search("Dijkstra_within", stats)
+        try:
+            with tm.phase("polygons"):
+                # cell and simplify are ground metres; the polygons are built in graph units
+                units = crs_scale(graph_crs, st.graph.lonlat[nodes])
+                geoms = isochrone.polygons(st.graph.coords[reached], costs, [v * scale for v in limits],
+                                           shape, cell * units, ratio)
+                counts = [int((costs <= v * scale).sum()) for v in limits]
+                out = isochrone.to_geojson(geoms, limits, counts, graph_crs, unit,
+                                           simplify * units if simplify else None)
+        except Exception as ex:
+            log.exception("Error building isochrone polygons")
+            return jsonify(error=f"processing error: {str(ex)}"), 500
+        out["sources"] = [{"node": n, "lonlat": st.graph.node_lonlat[n]} for n in nodes]
+        out["weight"] = weight
+        out["settled"] = stats["settled"]
+        if STATE is st:
+            ISOCHRONE_CACHE.put(key, out)
+    if want_timing():
+        out = dict(out, timing=tm.as_dict())
+    with tm.phase("serialize"):
+        return jsonify(out)
+
+@app.route("/cache/stats")
+def cache_stats():
+    return jsonify({**ROUTE_CACHE.stats(), "isochrone": ISOCHRONE_CACHE.stats()})
+
+@app.route("/metrics")
+def metrics_text():
+    st = STATE
+    METRICS.set("graph_version", st.version)
+    METRICS.set("graph_nodes", st.graph.num_nodes)
+    METRICS.set("graph_edges", st.graph.num_edges)
+    METRICS.set("ch_enabled", int(st.ch is not None))
+    for level, values in ROUTE_CACHE.stats().items():
+        for name, value in values.items():
+            METRICS.set(f"route_cache_{name}", value, level=level)
+    for name, value in ISOCHRONE_CACHE.stats().items():
+        METRICS.set(f"isochrone_cache_{name}", value)
+    METRICS.set("profile_rate_percent", PROFILER.rate)
+    METRICS.set("profiled_requests", PROFILER.sampled)
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+# GET: accumulated cProfile stats as text (?sort=tottime&limit=40)
+# POST {"rate": 5} or ?rate=5: profile 5% of requests from now on; DELETE: drop the stats
+@app.route("/debug/profile", methods=["GET", "POST", "DELETE"])
+def debug_profile():
+    if request.method == "DELETE":
+        PROFILER.reset()
+        return jsonify(rate=PROFILER.rate, sampled=PROFILER.sampled)
+    if request.method == "POST":
+        body = request.get_json(silent=True) or {}
+        try:
+            rate = float(body.get("rate", request.args.get("rate")))
+        except (TypeError, ValueError):
+            return jsonify(error="rate required (percent of requests, 0-100)"), 400
+        if not 0 <= rate <= 100:
+            return jsonify(error="rate must be between 0 and 100"), 400
+        PROFILER.rate = rate
+        log.info("Profiler: sampling %.1f%% of requests", rate)
+        return jsonify(rate=PROFILER.rate, sampled=PROFILER.sampled)
+    sort = request.args.get("sort", "cumulative")
+    try:
+        limit = int(request.args.get("limit", 40))
+        text = PROFILER.report(sort, limit)
+    except (KeyError, ValueError) as e:
+        return jsonify(error=f"bad sort/limit: {e}"), 400
+    return Response(text, mimetype="text/plain")
+
+def invalidate_routes(bbox, local, shared=True):
+    if local:
+        return ROUTE_CACHE.invalidate(bbox, shared=shared)
+    if shared:
+        ROUTE_CACHE.clear()
+    else:
+        ROUTE_CACHE.local.clear()
+    return None
+
+def apply_patch(patch):
+    global STATE
+    with PATCH_LOCK:
+        st = STATE
+        ps = st.patches.copy()
+        ps.apply(patch)
+        if not ps.active and not ps.nodes:
+            STATE = make_state(G, CH, ps, st.version + 1)
+            return
+        # The CH was built for the unpatched graph, so it is off until a reset
+        STATE = make_state(PatchedGraph(G, ps), None, ps, st.version + 1)
+
+def reset_patches():
+    global STATE
+    with PATCH_LOCK:
+        STATE = make_state(G, CH, PatchSet(G.num_nodes), STATE.version + 1)
+
+def sync_patches():
+    # Patches written by any worker (or before a restart) go through the journal.
+    # Returns the ids of records that could not be applied.
+    rejected = set()
+    if PATCH_LOG is None or not PATCH_LOG.changed():
+        return rejected
+    with PATCH_LOCK:
+        records = PATCH_LOG.read_new()
+        for rec in records:
+            if rec.get("reset"):
+                reset_patches()
+                invalidate_routes(None, False, shared=False)
+                continue
+            try:
+                apply_patch(rec["patch"])
+            except PatchError as e:
+                log.warning("Patch: skipping journal entry: %s", e)
+                rejected.add(rec.get("id"))
+                continue
+            invalidate_routes(rec["bbox"], rec["local"], shared=False)
+        if records:
+            log.info("Patch: graph at version %d %s", STATE.version, STATE.patches.summary())
+    return rejected
+
+def patch_status():
+    st = STATE
+    return {"version": st.version, "ch": st.ch is not None, **st.patches.summary()}
+
+@app.route("/patch", methods=["GET", "POST", "DELETE"])
+def patch():
+    if request.method == "GET":
+        sync_patches()
+        return jsonify(patch_status())
+    if request.method == "DELETE":
+        with PATCH_LOCK:
+            if PATCH_LOG is not None:
+                PATCH_LOG.append(reset=True)
+                sync_patches()
+            else:
+                reset_patches()
+            ROUTE_CACHE.clear()
+        return jsonify(patch_status())
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify(error="JSON body required"), 400
+    with PATCH_LOCK:
+        sync_patches()
+        st = STATE
+        try:
+            change, bbox, local = resolve(body, st.graph, G, st.patches, graph_crs)
+        except (PatchError, KeyError, TypeError, ValueError) as e:
+            return jsonify(error=f"bad patch: {e}"), 400
+        except Exception as ex:
+            log.exception("Error resolving patch")
+            return jsonify(error=f"processing error: {str(ex)}"), 500
+        if PATCH_LOG is not None:
+            # Another worker may have journalled a patch since ours was resolved;
+            # added node ids then clash and ours is skipped on replay everywhere
+            rec_id = PATCH_LOG.append(change, bbox, local)
+            if rec_id in sync_patches():
+                return jsonify(error="patch conflicts with one applied by another worker, send it again"), 409
+        else:
+            apply_patch(change)
+        dropped = invalidate_routes(bbox, local)
+    out = patch_status()
+    out.update(bbox=bbox, invalidated="area" if local else "all")
+    if dropped is not None:
+        out["dropped_routes"] = dropped
+    return jsonify(out)
+
+sync_patches()
+
+if __name__ == "__main__":
+    app.run(debug=True, port=5000, threaded=True)
@@ -0,0 +1,607 @@
+import argparse
+import gc
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+import numpy as np
+
+import algorithms
+from build_graph import build_graph_from_shp, build_graph_vectorized, simplify_graph
+from contraction import ContractionHierarchy, default_ch_path
+from graph_cache import load_or_build
+from matrix import MatrixPool, distance_matrix
+from profiles import Weighting
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DEFAULT_SHP = "mongolia-251026-free/gis_osm_roads_free_1.shp"
+
+
+def _mb(n):
+    return n / (1024 * 1024)
+
+
+def retained_bytes(fn):
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    t0 = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - t0
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current - base, peak - base, elapsed
+
+
+def bench_memory(args):
+    (G, _), dict_bytes, dict_peak, dict_time = retained_bytes(
+        lambda: build_graph_from_shp(args.shp))
+    C, csr_bytes, _, csr_time = retained_bytes(G.freeze)
+    edges = G.num_edges
+    del G
+
+    print(f"nodes={C.num_nodes:,} edges={edges:,}")
+    print(f"{'representation':<16}{'retained MB':>14}{'bytes/edge':>12}{'time s':>10}")
+    print(f"{'dict Graph':<16}{_mb(dict_bytes):>14.1f}{dict_bytes / max(edges, 1):>12.1f}{dict_time:>10.2f}")
+    print(f"{'CSRGraph':<16}{_mb(csr_bytes):>14.1f}{csr_bytes / max(edges, 1):>12.1f}{csr_time:>10.2f}")
+    print(f"dict Graph build peak: {_mb(dict_peak):.1f} MB, CSR arrays: {_mb(C.nbytes):.1f} MB")
+
+
+def bench_build(args):
+    t0 = time.perf_counter()
+    legacy, _ = build_graph_from_shp(args.shp, compact=True)
+    legacy_time = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    fast, _ = build_graph_vectorized(args.shp)
+    fast_time = time.perf_counter() - t0
+
+    a, b = legacy.to_arrays(), fast.to_arrays()
+    same = all(a[k].shape == b[k].shape and np.array_equal(a[k], b[k]) for k in a)
+    print(f"nodes={fast.num_nodes:,} edges={fast.num_edges:,} identical={same}")
+    print(f"build_graph_from_shp:   {legacy_time:8.2f} s")
+    print(f"build_graph_vectorized: {fast_time:8.2f} s  ({legacy_time / max(fast_time, 1e-9):.1f}x)")
+
+
+# Path-copying searches as they were before parent pointers, kept for comparison
+def legacy_bfs_shortest(graph, start, goal):
+    if start == goal:
+        return [start]
+    visited = {start}
+    q = deque([(start, [start])])
+    while q:
+        node, path = q.popleft()
+        for neigh, _, _ in graph.adj.get(node, []):
+            if neigh in visited:
+                continue
+            if neigh == goal:
+                return path + [neigh]
+            visited.add(neigh)
+            q.append((neigh, path + [neigh]))
+    return None
+
+
+def legacy_dfs_path_safe(graph, start, goal, max_nodes=1000000, max_depth=5000):
+    if start == goal:
+        return [start]
+    stack = [(start, [start])]
+    visited_nodes = 0
+    while stack:
+        node, path = stack.pop()
+        visited_nodes += 1
+        if visited_nodes > max_nodes:
+            return None
+        if len(path) > max_depth:
+            continue
+        if node == goal:
+            return path
+        for neigh, _, _ in graph.adj.get(node, []):
+            if neigh in path:
+                continue
+            stack.append((neigh, path + [neigh]))
+    return None
+
+
+def legacy_enumerate_paths_dfs(graph, start, goal, max_paths=50, max_depth=500, max_total_weight=None,
+                               max_iterations=5000000):
+    results = []
+    stack = [(start, [start], 0.0)]
+    iterations = 0
+    while stack and len(results) < max_paths:
+        iterations += 1
+        if iterations > max_iterations:
+            break
+        node, path, tw = stack.pop()
+        if len(path) > max_depth:
+            continue
+        if node == goal:
+            results.append((path, tw))
+            if len(results) >= max_paths:
+                break
+            continue
+        for neigh, w, _ in graph.adj.get(node, []):
+            if neigh in path:
+                continue
+            new_tw = tw + w
+            if max_total_weight and new_tw > max_total_weight:
+                continue
+            stack.append((neigh, path + [neigh], new_tw))
+    return results
+
+
+def measure(fn):
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def bench_search(args):
+    G, _, _ = load_or_build(args.shp)
+    rng = random.Random(args.seed)
+    pairs = [(rng.randrange(G.num_nodes), rng.randrange(G.num_nodes)) for _ in range(args.pairs)]
+
+    def enum_limits(s, t):
+        _, dist = algorithms.dijkstra(G, s, t)
+        mw = dist * 1.5 if dist != float("inf") else None
+        return dict(max_paths=args.max_paths, max_depth=args.max_depth, max_total_weight=mw,
+                    max_iterations=args.max_iterations)
+
+    cases = [
+        ("bfs_shortest", legacy_bfs_shortest, algorithms.bfs_shortest, lambda s, t: {}),
+        ("dfs_path_safe", legacy_dfs_path_safe, algorithms.dfs_path_safe,
+         lambda s, t: dict(max_nodes=args.max_nodes, max_depth=5000)),
+        ("enumerate_paths_dfs", legacy_enumerate_paths_dfs, algorithms.enumerate_paths_dfs, enum_limits),
+    ]
+    print(f"{len(pairs)} queries, seed={args.seed}")
+    print(f"{'algorithm':<22}{'version':<10}{'ms/query':>10}{'peak MB':>10}{'same':>6}")
+    for name, before, after, limits in cases:
+        rows = {"before": [0.0, 0], "after": [0.0, 0]}
+        same = True
+        for s, t in pairs:
+            kw = limits(s, t)
+            r0, t0, m0 = measure(lambda: before(G, s, t, **kw))
+            r1, t1, m1 = measure(lambda: after(G, s, t, **kw))
+            same = same and r0 == r1
+            rows["before"][0] += t0
+            rows["before"][1] = max(rows["before"][1], m0)
+            rows["after"][0] += t1
+            rows["after"][1] = max(rows["after"][1], m1)
+        for version, (total, peak) in rows.items():
+            print(f"{name:<22}{version:<10}{1000 * total / len(pairs):>10.2f}{_mb(peak):>10.2f}{str(same):>6}")
+
+
+def bench_simplify(args):
+    G, _, _ = load_or_build(args.shp)
+    t0 = time.perf_counter()
+    S = simplify_graph(G)
+    print(f"simplify_graph: {time.perf_counter() - t0:.2f} s")
+    kept = S.routable_nodes()
+    rng = random.Random(args.seed)
+    pairs = [(int(rng.choice(kept)), int(rng.choice(kept))) for _ in range(args.pairs)]
+
+    print(f"{len(pairs)} queries between kept nodes, seed={args.seed}")
+    print(f"{'graph':<12}{'nodes':>12}{'edges':>12}{'ms/query':>10}{'settled':>10}{'same':>6}")
+    results = {}
+    for name, graph in (("full", G), ("simplified", S)):
+        total, settled, dists = 0.0, 0, []
+        for s, t in pairs:
+            stats = {}
+            t0 = time.perf_counter()
+            _, dist = algorithms.dijkstra(graph, s, t, stats=stats)
+            total += time.perf_counter() - t0
+            settled += stats["settled"]
+            dists.append(dist)
+        results[name] = dists
+        same = all(a == b or abs(a - b) <= 1e-6 * max(a, 1.0) for a, b in zip(results["full"], dists))
+        print(f"{name:<12}{len(graph.routable_nodes()):>12,}"
+              f"{graph.num_edges:>12,}{1000 * total / len(pairs):>10.2f}{settled // len(pairs):>10,}{str(same):>6}")
+
+
+# Reproducible query sets, run in-process and through the Flask app. Every query is
+# written to a JSONL record that `replay` can run again on another commit.
+
+# engine -> (mode, alg) on /route
+HTTP_QUERIES = {
+    "bfs_shortest": ("minsteps", "bfs"),
+    "dfs_path_safe": ("minsteps", "dfs"),
+    "dijkstra": ("shortest", "dijkstra"),
+    "astar": ("shortest", "astar"),
+    "bidirectional_dijkstra": ("shortest", "bidijkstra"),
+    "ch": ("shortest", "ch"),
+    "enumerate_paths_dfs": ("all", "dfs"),
+    "k_shortest_paths": ("all", "ksp"),
+}
+
+
+def od_pairs(G, n, seed=0, strata=0):
+    """n (s, t, band) pairs of routable nodes. With strata > 0 they are spread evenly
+    over that many log-spaced straight-line distance bands, 500 m up to the extent."""
+    rng = np.random.default_rng(seed)
+    nodes = G.routable_nodes()
+    if not strata:
+        return [(int(s), int(t), None) for s, t in rng.choice(nodes, size=(n, 2))]
+    cand = rng.choice(nodes, size=(n * 50, 2))
+    d = np.hypot(*(G.coords[cand[:, 0]] - G.coords[cand[:, 1]]).T)
+    extent = float(np.hypot(*np.ptp(G.coords[nodes], axis=0)))
+    edges = np.geomspace(500.0, max(extent, 1000.0), strata + 1)
+    edges[0] = 0.0
+    per_band = -(-n // strata)
+    pairs = []
+    for band, (lo, hi) in enumerate(zip(edges, edges[1:])):
+        idx = np.flatnonzero((d >= lo) & (d < hi))[:per_band]
+        pairs += [(int(s), int(t), band) for s, t in cand[idx]]
+    return pairs[:n]
+
+
+def _one(path, cost=None):
+    return path, cost, int(path is not None)
+
+
+def _best(paths):
+    if not paths:
+        return None, None, 0
+    return paths[0][0], min(w for _, w in paths), len(paths)
+
+
+def inprocess_engines(graph, ch, args):
+    """engine -> fn(s, t, stats) returning (path, cost, paths found)."""
+    def enumerate_paths(s, t, stats):
+        _, dist = algorithms.dijkstra(graph, s, t)
+        bound = dist * 1.5 if dist != float("inf") else None
+        return _best(algorithms.enumerate_paths_dfs(
+            graph, s, t, max_paths=args.max_paths, max_depth=args.max_depth,
+            max_total_weight=bound, max_iterations=args.max_iterations))
+
+    engines = {
+        "bfs_shortest": lambda s, t, stats: _one(algorithms.bfs_shortest(graph, s, t)),
+        "dfs_path_safe": lambda s, t, stats: _one(
+            algorithms.dfs_path_safe(graph, s, t, max_nodes=args.max_nodes, max_depth=5000)),
+        "dijkstra": lambda s, t, stats: _one(*algorithms.dijkstra(graph, s, t, stats=stats)),
+        "astar": lambda s, t, stats: _one(*algorithms.astar(graph, s, t, stats=stats)),
+        "bidirectional_dijkstra": lambda s, t, stats: _one(
+            *algorithms.bidirectional_dijkstra(graph, s, t, stats=stats)),
+        "enumerate_paths_dfs": enumerate_paths,
+        "k_shortest_paths": lambda s, t, stats: _best(
+            algorithms.k_shortest_paths(graph, s, t, k=args.max_paths, stats=stats)),
+    }
+    if ch is not None:
+        engines["ch"] = lambda s, t, stats: _one(*ch.query(s, t, stats=stats))
+    return engines
+
+
+def http_engines(G, args):
+    """The same engines through /route on the Flask test client, so snapping, the
+    projection and JSON serialization are part of every timing."""
+    os.environ["OSM_SHP"] = args.shp
+    os.environ["OSM_SIMPLIFY"] = "1" if args.simplify else "0"
+    os.environ.setdefault("OSM_PATCHES", "off")
+    os.environ.setdefault("ROUTE_CACHE_SHARED", "off")
+    os.environ.setdefault("ROUTE_CACHE_ENTRIES", "0")
+    import app
+    client = app.app.test_client()
+
+    def engine(mode, alg):
+        def run(s, t, stats):
+            (lon1, lat1), (lon2, lat2) = G.lonlat[s].tolist(), G.lonlat[t].tolist()
+            data = client.get("/route", query_string={
+                "src": f"{lon1!r},{lat1!r}", "dst": f"{lon2!r},{lat2!r}", "mode": mode, "alg": alg,
+                "weight": args.weight, "max_paths": args.max_paths, "max_depth": args.max_depth,
+                "format": "polyline"}).get_json()
+            if "settled" in data:
+                stats["settled"] = data["settled"]
+            if data.get("paths"):
+                return None, min(p["weight"] for p in data["paths"]), len(data["paths"])
+            return None, data.get("cost", data.get("distance")), int("path" in data)
+        return run
+
+    return {name: engine(*q) for name, q in HTTP_QUERIES.items()
+            if name != "ch" or (app.STATE.ch is not None and args.weight == "distance")}
+
+
+def run_queries(engines, queries, record=None, target="inprocess"):
+    """queries: (engine, s, t, band). Returns one record per query that has an engine."""
+    recs = []
+    for name, s, t, band in queries:
+        fn = engines.get(name)
+        if fn is None:
+            continue
+        stats = {}
+        t0 = time.perf_counter()
+        path, cost, found = fn(s, t, stats)
+        ms = 1000 * (time.perf_counter() - t0)
+        rec = {"target": target, "engine": name, "s": s, "t": t, "band": band, "ms": round(ms, 3),
+               "settled": stats.get("settled"), "found": found,
+               "cost": round(cost, 3) if cost is not None else None}
+        recs.append(rec)
+        if record is not None:
+            record.write(json.dumps(rec) + "\n")
+    return recs
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    a = np.asarray(values, dtype=np.float64)
+    p50, p95, p99 = np.percentile(a, [50, 95, 99]).tolist()
+    return {"p50": round(p50, 3), "p95": round(p95, 3), "p99": round(p99, 3),
+            "mean": round(float(a.mean()), 3), "max": round(float(a.max()), 3)}
+
+
+def summarize(recs, engines=None, memory_queries=0):
+    """Per target and engine: latency and settled-node percentiles, plus the peak
+    traced memory of the first memory_queries queries (timed runs are untraced)."""
+    out = {}
+    for rec in recs:
+        out.setdefault(rec["target"], {}).setdefault(rec["engine"], []).append(rec)
+    for target, by_engine in out.items():
+        for name, rows in by_engine.items():
+            summary = {
+                "queries": len(rows),
+                "found": sum(1 for r in rows if r["found"]),
+                "latency_ms": _percentiles([r["ms"] for r in rows]),
+                "settled": _percentiles([r["settled"] for r in rows if r["settled"] is not None]),
+            }
+            fn = (engines or {}).get(target, {}).get(name)
+            if fn is not None and memory_queries:
+                peak = max(measure(lambda: fn(r["s"], r["t"], {}))[2] for r in rows[:memory_queries])
+                summary["peak_mb"] = round(_mb(peak), 3)
+            by_engine[name] = summary
+    return out
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _setup(args):
+    t0 = time.perf_counter()
+    G, _, key = load_or_build(args.shp, simplify=args.simplify)
+    load_s = time.perf_counter() - t0
+    build_s = None
+    if args.build:
+        t0 = time.perf_counter()
+        build_graph_vectorized(args.shp)
+        build_s = round(time.perf_counter() - t0, 3)
+    ch = None
+    if args.weight == "distance":
+        ch = ContractionHierarchy.load(default_ch_path(args.shp, args.simplify), key)
+    meta = {"shp": args.shp, "graph_key": key, "simplify": args.simplify, "weight": args.weight,
+            "nodes": G.num_nodes, "edges": G.num_edges, "commit": _git_commit(),
+            "load_s": round(load_s, 3), "build_s": build_s}
+
+    engines = {}
+    if args.target in ("inprocess", "both"):
+        engines["inprocess"] = inprocess_engines(Weighting(G).view(args.weight), ch, args)
+    if args.target in ("http", "both"):
+        engines["http"] = http_engines(G, args)
+    return G, engines, meta
+
+
+def _run(engines, queries, meta, args):
+    """queries: (target, engine, s, t, band)."""
+    names = set(args.engines.split(",")) if args.engines else None
+    record = open(args.record, "w") if args.record else None
+    recs = []
+    try:
+        if record is not None:
+            record.write(json.dumps({"meta": meta}) + "\n")
+        for target, by_name in engines.items():
+            chosen = {n: fn for n, fn in by_name.items() if names is None or n in names}
+            recs += run_queries(chosen, [q[1:] for q in queries if q[0] == target], record, target)
+    finally:
+        if record is not None:
+            record.close()
+    return recs
+
+
+def _write_report(report, path):
+    text = json.dumps(report, indent=2)
+    if path:
+        with open(path, "w") as f:
+            f.write(text + "\n")
+        print("Report:", path)
+    else:
+        print(text)
+
+
+def bench_run(args):
+    G, engines, meta = _setup(args)
+    pairs = od_pairs(G, args.pairs, args.seed, args.strata)
+    meta.update(seed=args.seed, pairs=len(pairs), strata=args.strata)
+    queries = [(target, name, s, t, band) for target in engines for name in HTTP_QUERIES
+               for s, t, band in pairs]
+    recs = _run(engines, queries, meta, args)
+    meta["peak_rss_mb"] = _peak_rss_mb()
+    _write_report({"meta": meta, "results": summarize(recs, engines, args.memory_queries)}, args.out)
+
+
+def read_record(path):
+    meta, recs = None, []
+    with open(path) as f:
+        for line in f:
+            rec = json.loads(line)
+            if "meta" in rec:
+                meta = rec["meta"]
+            else:
+                recs.append(rec)
+    return meta, recs
+
+
+def _same_cost(a, b):
+    if a is None or b is None:
+        return a is b
+    return abs(a - b) <= 1e-3 * max(1.0, abs(a))
+
+
+def bench_replay(args):
+    old_meta, old = read_record(args.replay)
+    args.shp = args.shp or old_meta["shp"]
+    args.weight = args.weight or old_meta["weight"]
+    args.simplify = args.simplify or old_meta["simplify"]
+    targets = {r["target"] for r in old}
+    args.target = "both" if len(targets) > 1 else targets.pop()
+    G, engines, meta = _setup(args)
+    if meta["graph_key"] != old_meta["graph_key"]:
+        print("warning: the graph differs from the recorded one, node ids may not match")
+    meta.update(replay_of=args.replay, recorded_commit=old_meta.get("commit"))
+
+    recs = _run(engines, [(r["target"], r["engine"], r["s"], r["t"], r["band"]) for r in old], meta, args)
+    meta["peak_rss_mb"] = _peak_rss_mb()
+
+    before = summarize(old)
+    after = summarize(recs, engines, args.memory_queries)
+    # Same queries in the same order, so answers can be compared one by one
+    by_key = {}
+    for r in old:
+        by_key.setdefault((r["target"], r["engine"]), []).append(r)
+    changed = {}
+    for key, rows in by_key.items():
+        new = [r for r in recs if (r["target"], r["engine"]) == key]
+        changed[key] = sum(1 for a, b in zip(rows, new)
+                           if a["found"] != b["found"] or not _same_cost(a["cost"], b["cost"]))
+    comparison = {}
+    for target, by_engine in after.items():
+        for name, summary in by_engine.items():
+            old_p50 = before.get(target, {}).get(name, {}).get("latency_ms", {}).get("p50")
+            new_p50 = summary["latency_ms"]["p50"]
+            comparison.setdefault(target, {})[name] = {
+                "p50_ms_before": old_p50, "p50_ms_after": new_p50,
+                "speedup": round(old_p50 / new_p50, 2) if old_p50 and new_p50 else None,
+                "results_changed": changed.get((target, name)),
+            }
+    _write_report({"meta": meta, "results": after, "comparison": comparison}, args.out)
+
+
+def bench_matrix(args):
+    # Concurrent matrices on different weights, pooled and in-thread, against a serial reference
+    G, _, _ = load_or_build(args.shp)
+    weighting = Weighting(G)
+    weights = args.weights.split(",")
+    rng = random.Random(args.seed)
+    kept = G.routable_nodes()
+    points = [int(rng.choice(kept)) for _ in range(args.points)]
+    expected = {w: distance_matrix(weighting.view(w), points, points)[0] for w in weights}
+    pool = MatrixPool(G, args.workers).start()
+    jobs = [(weights[i % len(weights)], pool if i % 2 else None) for i in range(args.threads * args.rounds)]
+    wrong = []
+    lock = threading.Lock()
+
+    def worker(chunk):
+        for w, p in chunk:
+            got = distance_matrix(weighting.view(w), points, points, p)[0]
+            if got != expected[w]:
+                with lock:
+                    wrong.append(w)
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(jobs[i::args.threads],)) for i in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    pool.close()
+    print(f"{len(jobs)} matrices of {args.points}x{args.points} on {args.threads} threads, "
+          f"weights {weights}: {len(wrong)} wrong, {time.perf_counter() - t0:.2f} s")
+    if wrong:
+        raise SystemExit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Route finder benchmarks")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("memory", help="memory of dict Graph vs CSRGraph")
+    p.add_argument("--shp", default=DEFAULT_SHP)
+    p.set_defaults(func=bench_memory)
+
+    p = sub.add_parser("build", help="iterrows builder vs vectorized builder")
+    p.add_argument("--shp", default=DEFAULT_SHP)
+    p.set_defaults(func=bench_build)
+
+    p = sub.add_parser("search", help="path-copying BFS/DFS vs parent-pointer versions")
+    p.add_argument("--shp", default=DEFAULT_SHP)
+    p.add_argument("--pairs", type=int, default=20)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--max-nodes", type=int, default=200000)
+    p.add_argument("--max-paths", type=int, default=20)
+    p.add_argument("--max-depth", type=int, default=300)
+    p.add_argument("--max-iterations", type=int, default=200000)
+    p.set_defaults(func=bench_search)
+
+    p = sub.add_parser("simplify", help="Dijkstra on the full graph vs the degree-2 simplified graph")
+    p.add_argument("--shp", default=DEFAULT_SHP)
+    p.add_argument("--pairs", type=int, default=200)
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=bench_simplify)
+
+    p = sub.add_parser("matrix", help="concurrent /matrix computations on different weights")
+    p.add_argument("--shp", default=DEFAULT_SHP)
+    p.add_argument("--points", type=int, default=8)
+    p.add_argument("--threads", type=int, default=4)
+    p.add_argument("--rounds", type=int, default=5)
+    p.add_argument("--workers", type=int, default=2)
+    p.add_argument("--weights", default="distance,car")
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=bench_matrix)
+
+    def query_args(p):
+        p.add_argument("--target", choices=("inprocess", "http", "both"), default="inprocess")
+        p.add_argument("--engines", help="comma-separated subset, e.g. dijkstra,astar,ch")
+        p.add_argument("--record", help="write every query to this JSONL file")
+        p.add_argument("--out", help="write the JSON report here instead of stdout")
+        p.add_argument("--build", action="store_true", help="also time a full graph build")
+        p.add_argument("--memory-queries", type=int, default=5,
+                       help="queries per engine re-run under tracemalloc for peak memory")
+        p.add_argument("--max-nodes", type=int, default=200000)
+        p.add_argument("--max-paths", type=int, default=10)
+        p.add_argument("--max-depth", type=int, default=300)
+        p.add_argument("--max-iterations", type=int, default=200000)
+
+    p = sub.add_parser("run", help="seeded OD pairs through every engine, JSON report")
+    p.add_argument("--shp", default=DEFAULT_SHP)
+    p.add_argument("--pairs", type=int, default=100)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--strata", type=int, default=0, help="distance bands to spread the pairs over")
+    p.add_argument("--weight", default="distance")
+    p.add_argument("--simplify", action="store_true")
+    query_args(p)
+    p.set_defaults(func=bench_run)
+
+    p = sub.add_parser("replay", help="re-run a recorded query file and compare")
+    p.add_argument("replay", help="JSONL file written by run --record")
+    p.add_argument("--shp")
+    p.add_argument("--weight")
+    p.add_argument("--simplify", action="store_true")
+    query_args(p)
+    p.set_defaults(func=bench_replay)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
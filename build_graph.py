@@ -1,88 +1,546 @@
-from shapely.geometry import LineString
-import geopandas as gpd
-from collections import defaultdict
-from pyproj import Transformer
-
-SNAP_TOLERANCE = 1e-6
-
-def round_coord(coord, tol=SNAP_TOLERANCE):
-    return (round(coord[0]/tol)*tol, round(coord[1]/tol)*tol)
-
-class Graph:
-    def __init__(self):
-        self.adj = defaultdict(list)
-        self.coord_to_node = {}
-        self.node_coords = {}
-        self.node_lonlat = {}
-        self.next_node_id = 0
-
-    def get_node(self, coord_graph):
-        rc = round_coord(coord_graph)
-        if rc in self.coord_to_node:
-            return self.coord_to_node[rc]
-        nid = self.next_node_id
-        self.next_node_id += 1
-        self.coord_to_node[rc] = nid
-        self.node_coords[nid] = rc
-        return nid
-
-    def add_edge(self, a_coord_graph, b_coord_graph, weight=1.0, meta=None, one_way=False):
-        a = self.get_node(a_coord_graph)
-        b = self.get_node(b_coord_graph)
-        self.adj[a].append((b, float(weight), meta))
-        if not one_way:
-            self.adj[b].append((a, float(weight), meta))
-
-def build_graph_from_shp(shp_path, target_epsg=3857):
-    print("Reading...:", shp_path)
-    gdf = gpd.read_file(shp_path)
-    print("Loaded.:", len(gdf))
-
-    if gdf.crs is None:
-        raise ValueError("crs error!.")
-
-    # Reproject if needed
-    if target_epsg and getattr(gdf.crs, "to_epsg", lambda: None)() != target_epsg:
-        print(f" {gdf.crs}-ees:{target_epsg}")
-        gdf = gdf.to_crs(epsg=target_epsg)
-
-    graph_crs = gdf.crs
-    to_wgs84 = Transformer.from_crs(graph_crs.to_string(), "EPSG:4326", always_xy=True)
-
-    G = Graph()
-    processed_segments = 0
-    
-    for idx, row in gdf.iterrows():
-        geom = row.geometry
-        if geom is None:
-            continue
-        
-        segments = [geom] if geom.geom_type == "LineString" else list(geom.geoms)
-        
-        for seg in segments:
-            coords = list(seg.coords)
-            for i in range(len(coords)-1):
-                a = coords[i]
-                b = coords[i+1]
-                length = LineString([a, b]).length
-                G.add_edge(
-                    (float(a[0]), float(a[1])), 
-                    (float(b[0]), float(b[1])), 
-                    weight=float(length)
-                )
-                processed_segments += 1
-        
-        if (idx + 1) % 10000 == 0:
-            print(f"  Processed {idx + 1}/{len(gdf)} features...")
-
-    print("WGS84...")
-    for nid, (x, y) in G.node_coords.items():
-        lon, lat = to_wgs84.transform(x, y)
-        G.node_lonlat[nid] = (float(lon), float(lat))
-
-    print("✅")
-    print(f"   - Nodes: {len(G.node_coords):,}")
-    print(f"   - Edges: {sum(len(v) for v in G.adj.values()):,}")
-    print(f"   - Segments: {processed_segments:,}")
-    
-    return G, graph_crs
\ No newline at end of file
+import shapely
+import geopandas as gpd
+from collections import defaultdict
+from itertools import repeat
+from pyproj import Geod, Proj, Transformer
+import numpy as np
+import pandas as pd
+
+SNAP_TOLERANCE = 1e-6
+WGS84 = Geod(ellps="WGS84")
+
+def round_coord(coord, tol=SNAP_TOLERANCE):
+    return (round(coord[0]/tol)*tol, round(coord[1]/tol)*tol)
+
+class Graph:
+    def __init__(self):
+        self.adj = defaultdict(list)
+        self.coord_to_node = {}
+        self.node_coords = {}
+        self.node_lonlat = {}
+        self.next_node_id = 0
+        self.classes = []
+        self._heuristic_scale = None
+
+    def get_node(self, coord_graph):
+        rc = round_coord(coord_graph)
+        if rc in self.coord_to_node:
+            return self.coord_to_node[rc]
+        nid = self.next_node_id
+        self.next_node_id += 1
+        self.coord_to_node[rc] = nid
+        self.node_coords[nid] = rc
+        return nid
+
+    def add_edge(self, a_coord_graph, b_coord_graph, weight=1.0, meta=None, one_way=False):
+        a = self.get_node(a_coord_graph)
+        b = self.get_node(b_coord_graph)
+        self.adj[a].append((b, float(weight), meta))
+        if not one_way:
+            self.adj[b].append((a, float(weight), meta))
+
+    @property
+    def num_nodes(self):
+        return self.next_node_id
+
+    @property
+    def num_edges(self):
+        return sum(len(v) for v in self.adj.values())
+
+    @property
+    def heuristic_scale(self):
+        # See CSRGraph.heuristic_scale
+        if self._heuristic_scale is None:
+            ratios = [w / d for u, edges in self.adj.items() for v, w, _ in edges
+                      if (d := np.hypot(self.node_coords[v][0] - self.node_coords[u][0],
+                                        self.node_coords[v][1] - self.node_coords[u][1])) > 0]
+            self._heuristic_scale = float(min(ratios)) if ratios else 0.0
+        return self._heuristic_scale
+
+    def freeze(self):
+        return CSRGraph.from_graph(self)
+
+def segment_lengths(a, b, to_wgs84):
+    # Edge weights are metres on the ground: the graph CRS (Web Mercator by default)
+    # stretches lengths by 1/cos(latitude), so measure the geodesic instead
+    lon1, lat1 = to_wgs84.transform(a[:, 0], a[:, 1])
+    lon2, lat2 = to_wgs84.transform(b[:, 0], b[:, 1])
+    return np.asarray(WGS84.inv(lon1, lat1, lon2, lat2)[2], dtype=np.float64).reshape(len(a))
+
+def crs_scales(graph_crs, lonlat):
+    """Graph CRS units per ground metre at each point (1/cos(lat) in Web Mercator)."""
+    f = Proj(graph_crs).get_factors(lonlat[:, 0], lonlat[:, 1])
+    return np.sqrt(f.areal_scale)
+
+def crs_scale(graph_crs, lonlat):
+    """The same for an area around these points, to turn cell sizes and
+    tolerances given in metres into graph units."""
+    return float(np.sqrt(np.mean(crs_scales(graph_crs, lonlat) ** 2)))
+
+def read_roads(shp_path, target_epsg=3857):
+    print("Reading...:", shp_path)
+    gdf = gpd.read_file(shp_path)
+    print("Loaded.:", len(gdf))
+
+    if gdf.crs is None:
+        raise ValueError("crs error!.")
+
+    # Reproject if needed
+    if target_epsg and getattr(gdf.crs, "to_epsg", lambda: None)() != target_epsg:
+        print(f" {gdf.crs}-ees:{target_epsg}")
+        gdf = gdf.to_crs(epsg=target_epsg)
+    return gdf
+
+def road_classes(gdf):
+    # One small id per distinct (fclass, maxspeed), in order of first appearance
+    n = len(gdf)
+    fclass = gdf["fclass"].fillna("").astype(str) if "fclass" in gdf else pd.Series([""] * n, index=gdf.index)
+    maxspeed = (pd.to_numeric(gdf["maxspeed"], errors="coerce").fillna(0).astype(np.int32)
+                if "maxspeed" in gdf else pd.Series(np.zeros(n, dtype=np.int32), index=gdf.index))
+    codes, uniques = pd.MultiIndex.from_arrays([fclass, maxspeed]).factorize()
+    if len(uniques) == 0:
+        return np.zeros(n, dtype=np.uint16), [("", 0)]
+    return codes.astype(np.uint16), [(str(f), int(m)) for f, m in uniques]
+
+def oneway_flags(gdf):
+    # OSM roads shapefile: B = both ways, F = digitised direction only, T = against it
+    if "oneway" not in gdf:
+        return np.full(len(gdf), "B")
+    return gdf["oneway"].fillna("B").astype(str).str.upper().str[:1].to_numpy()
+
+def build_graph_from_shp(shp_path, target_epsg=3857, compact=False):
+    gdf = read_roads(shp_path, target_epsg)
+    graph_crs = gdf.crs
+    to_wgs84 = Transformer.from_crs(graph_crs.to_string(), "EPSG:4326", always_xy=True)
+
+    G = Graph()
+    class_ids, G.classes = road_classes(gdf)
+    oneway = oneway_flags(gdf)
+    processed_segments = 0
+    
+    for idx, row in gdf.iterrows():
+        geom = row.geometry
+        if geom is None:
+            continue
+        
+        segments = [geom] if geom.geom_type == "LineString" else list(geom.geoms)
+        
+        for seg in segments:
+            coords = np.asarray(seg.coords, dtype=np.float64)[:, :2]
+            starts, ends = coords[:-1], coords[1:]
+            if oneway[idx] == "T":
+                starts, ends = ends, starts
+            lengths = segment_lengths(starts, ends, to_wgs84)
+            for i in range(len(coords)-1):
+                a = starts[i]
+                b = ends[i]
+                length = lengths[i]
+                G.add_edge(
+                    (float(a[0]), float(a[1])), 
+                    (float(b[0]), float(b[1])), 
+                    weight=float(length),
+                    meta=int(class_ids[idx]),
+                    one_way=oneway[idx] in ("F", "T")
+                )
+                processed_segments += 1
+        
+        if (idx + 1) % 10000 == 0:
+            print(f"  Processed {idx + 1}/{len(gdf)} features...")
+
+    print("WGS84...")
+    for nid, (x, y) in G.node_coords.items():
+        lon, lat = to_wgs84.transform(x, y)
+        G.node_lonlat[nid] = (float(lon), float(lat))
+
+    print("✅")
+    print(f"   - Nodes: {len(G.node_coords):,}")
+    print(f"   - Edges: {sum(len(v) for v in G.adj.values()):,}")
+    print(f"   - Segments: {processed_segments:,}")
+
+    if compact:
+        return G.freeze(), graph_crs
+    return G, graph_crs
+
+def road_segments(gdf):
+    """Straight segments of every road as (a, b, lengths, class ids, two_way, classes).
+
+    a -> b is the direction of travel for one-way roads; lengths are geodesic metres."""
+    class_ids, classes = road_classes(gdf)
+    oneway = oneway_flags(gdf)
+    geoms = gdf.geometry.values
+    rows = np.flatnonzero(~shapely.is_missing(geoms))
+    parts, part_row = shapely.get_parts(geoms[rows], return_index=True)
+    coords, part_idx = shapely.get_coordinates(parts, return_index=True)
+
+    # Consecutive vertices of the same part form a segment
+    same = part_idx[:-1] == part_idx[1:]
+    seg_row = rows[part_row[part_idx[:-1][same]]]
+    backward = (oneway[seg_row] == "T")[:, None]
+    a = np.where(backward, coords[1:][same], coords[:-1][same])
+    b = np.where(backward, coords[:-1][same], coords[1:][same])
+    to_wgs84 = Transformer.from_crs(gdf.crs.to_string(), "EPSG:4326", always_xy=True)
+    lengths = segment_lengths(a, b, to_wgs84)
+    two_way = ~np.isin(oneway[seg_row], ("F", "T"))
+    return a, b, lengths, class_ids[seg_row], two_way, classes
+
+def build_graph_vectorized(shp_path, target_epsg=3857, tol=SNAP_TOLERANCE):
+    gdf = read_roads(shp_path, target_epsg)
+    graph_crs = gdf.crs
+    to_wgs84 = Transformer.from_crs(graph_crs.to_string(), "EPSG:4326", always_xy=True)
+
+    a, b, lengths, seg_class, two_way, classes = road_segments(gdf)
+    n_seg = len(lengths)
+
+    # Endpoints in a0, b0, a1, b1, ... order so ids follow first appearance like Graph.get_node
+    ends = np.empty((2 * n_seg, 2), dtype=np.float64)
+    ends[0::2], ends[1::2] = a, b
+    keys = np.round(ends / tol).astype(np.int64)
+    uniq, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind="stable")
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order), dtype=np.int32)
+    node = rank[inverse.reshape(-1)]
+    node_coords = uniq[order].astype(np.float64) * tol
+
+    print("WGS84...")
+    lon, lat = to_wgs84.transform(node_coords[:, 0], node_coords[:, 1])
+    lonlat = np.column_stack([lon, lat]).astype(np.float64)
+
+    # Each segment is a->b then b->a (unless one-way); a stable sort by source keeps Graph.adj order
+    keep = np.ones(2 * n_seg, dtype=bool)
+    keep[1::2] = two_way
+    src = node[keep]
+    dst = node.reshape(-1, 2)[:, ::-1].reshape(-1)[keep]
+    weights = np.repeat(lengths, 2)[keep]
+    edge_class = np.repeat(seg_class, 2)[keep]
+    by_src = np.argsort(src, kind="stable")
+    n = len(node_coords)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n), out=offsets[1:])
+
+    G = CSRGraph(offsets, dst[by_src].astype(np.int32), weights[by_src], node_coords, lonlat,
+                 edge_class=edge_class[by_src], classes=classes)
+    print("✅")
+    print(f"   - Nodes: {G.num_nodes:,}")
+    print(f"   - Edges: {G.num_edges:,}")
+    print(f"   - Segments: {n_seg:,}")
+    return G, graph_crs
+
+class _CSRAdjacency:
+    # edge_ids: for the reverse CSR, the forward edge behind each entry, so
+    # weights and classes are read from the forward arrays
+    def __init__(self, offsets, targets, weights, edge_class=None, factors=None, edge_ids=None):
+        self.offsets = offsets
+        self.targets = targets
+        self.weights = weights
+        self.edge_class = edge_class
+        self.factors = factors
+        self.edge_ids = edge_ids
+
+    def get(self, node, default=None):
+        if node < 0 or node >= len(self.offsets) - 1:
+            return default
+        a, b = int(self.offsets[node]), int(self.offsets[node + 1])
+        e = slice(a, b) if self.edge_ids is None else self.edge_ids[a:b]
+        if self.factors is None:
+            return list(zip(self.targets[a:b].tolist(), self.weights[e].tolist(), repeat(None, b - a)))
+        # Weighted view: cost = length * per-class factor, inf means the class is closed
+        w = self.weights[e] * self.factors[self.edge_class[e]]
+        open_ = np.isfinite(w)
+        return list(zip(self.targets[a:b][open_].tolist(), w[open_].tolist(), repeat(None, int(open_.sum()))))
+
+    def __getitem__(self, node):
+        return self.get(node, [])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class _NodeRows:
+    def __init__(self, arr):
+        self.arr = arr
+
+    def __getitem__(self, nid):
+        x, y = self.arr[nid].tolist()
+        return (x, y)
+
+    def __len__(self):
+        return len(self.arr)
+
+    def items(self):
+        return enumerate(map(tuple, self.arr.tolist()))
+
+
+class CSRGraph:
+    def __init__(self, offsets, targets, weights, coords, lonlat, via_offsets=None, via_nodes=None,
+                 edge_class=None, classes=None, reverse=None):
+        self.offsets = offsets
+        self.targets = targets
+        self.weights = weights
+        self.coords = coords
+        self.lonlat = lonlat
+        # Set on simplified graphs: per-edge interior nodes of the contracted chain
+        self.via_offsets = via_offsets
+        self.via_nodes = via_nodes
+        # Per-edge index into classes, a small table of (fclass, maxspeed)
+        if edge_class is None:
+            edge_class = np.zeros(len(targets), dtype=np.uint16)
+        self.edge_class = edge_class
+        self.classes = [tuple(c) for c in classes] if classes else [("", 0)]
+        for arr in (offsets, targets, weights, coords, lonlat, via_offsets, via_nodes, edge_class,
+                    *(reverse or ())):
+            if arr is not None:
+                arr.flags.writeable = False
+        self.adj = self.adjacency()
+        self.node_coords = _NodeRows(coords)
+        self.node_lonlat = _NodeRows(lonlat)
+        self.index = None
+        # (offsets, sources, forward edge ids) of incoming edges; mapped from the
+        # graph cache, or built on first use for graphs that were not loaded from it
+        self._reverse = reverse
+        self._heuristic_scale = None
+
+    @property
+    def num_nodes(self):
+        return len(self.offsets) - 1
+
+    @property
+    def heuristic_scale(self):
+        # Weights are ground metres but A* measures straight lines in the graph CRS.
+        # The lowest weight per unit of straight line over all edges keeps that
+        # estimate a lower bound (about cos(latitude) in Web Mercator).
+        if self._heuristic_scale is None:
+            src = np.repeat(np.arange(self.num_nodes, dtype=np.int64), np.diff(self.offsets))
+            chord = np.hypot(*(self.coords[self.targets] - self.coords[src]).T)
+            ok = chord > 0
+            self._heuristic_scale = float((self.weights[ok] / chord[ok]).min()) if ok.any() else 0.0
+        return self._heuristic_scale
+
+    @property
+    def num_edges(self):
+        return len(self.targets)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self.to_arrays().values())
+
+    def neighbors(self, node):
+        return self.targets[self.offsets[node]:self.offsets[node + 1]]
+
+    def freeze(self):
+        return self
+
+    def reverse_arrays(self):
+        # Incoming edges per node (backward searches on one-way roads)
+        if self._reverse is None:
+            n = self.num_nodes
+            src = np.repeat(np.arange(n, dtype=np.int32), np.diff(self.offsets))
+            order = np.argsort(self.targets, kind="stable")
+            offsets = np.zeros(n + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.targets, minlength=n), out=offsets[1:])
+            self._reverse = (offsets, src[order], order)
+        return self._reverse
+
+    def adjacency(self, factors=None):
+        return _CSRAdjacency(self.offsets, self.targets, self.weights, self.edge_class, factors)
+
+    def reverse_adjacency(self, factors=None):
+        offsets, sources, edge_ids = self.reverse_arrays()
+        return _CSRAdjacency(offsets, sources, self.weights, self.edge_class, factors, edge_ids)
+
+    @property
+    def radj(self):
+        return self.reverse_adjacency()
+
+    def weighted(self, factors):
+        return WeightedView(self, factors)
+
+    def routable_nodes(self):
+        has_edge = np.diff(self.offsets) > 0
+        has_edge[self.targets] = True
+        return np.flatnonzero(has_edge)
+
+    def _edge_between(self, u, v, factors=None):
+        a, b = int(self.offsets[u]), int(self.offsets[u + 1])
+        best, best_w = None, float("inf")
+        for i in range(a, b):
+            if self.targets[i] != v:
+                continue
+            w = self.weights[i] if factors is None else self.weights[i] * factors[self.edge_class[i]]
+            if w < best_w:
+                best, best_w = i, w
+        return best
+
+    def expand_path(self, path, factors=None):
+        if self.via_offsets is None or not path:
+            return path
+        out = [path[0]]
+        for u, v in zip(path, path[1:]):
+            e = self._edge_between(u, v, factors)
+            out.extend(self.via_nodes[self.via_offsets[e]:self.via_offsets[e + 1]].tolist())
+            out.append(v)
+        return out
+
+    def path_length(self, path, factors=None):
+        return float(sum(self.weights[self._edge_between(u, v, factors)] for u, v in zip(path, path[1:])))
+
+    @classmethod
+    def from_graph(cls, G):
+        n = G.next_node_id
+        counts = [0] * n
+        targets, weights, edge_class = [], [], []
+        for nid in range(n):
+            edges = G.adj.get(nid, ())
+            counts[nid] = len(edges)
+            for neigh, w, meta in edges:
+                targets.append(neigh)
+                weights.append(w)
+                edge_class.append(meta or 0)
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        coords = np.array([G.node_coords[i] for i in range(n)], dtype=np.float64).reshape(n, 2)
+        lonlat = np.array([G.node_lonlat[i] for i in range(n)], dtype=np.float64).reshape(n, 2)
+        return cls(offsets, np.array(targets, dtype=np.int32), np.array(weights, dtype=np.float64),
+                   coords, lonlat, edge_class=np.array(edge_class, dtype=np.uint16), classes=G.classes)
+
+    def to_arrays(self):
+        arrays = {
+            "offsets": self.offsets,
+            "targets": self.targets,
+            "weights": self.weights,
+            "coords": self.coords,
+            "lonlat": self.lonlat,
+            "edge_class": self.edge_class,
+            "class_fclass": np.array([c[0] for c in self.classes]),
+            "class_maxspeed": np.array([c[1] for c in self.classes], dtype=np.int32),
+        }
+        if self.via_offsets is not None:
+            arrays["via_offsets"] = self.via_offsets
+            arrays["via_nodes"] = self.via_nodes
+        arrays["rev_offsets"], arrays["rev_sources"], arrays["rev_edges"] = self.reverse_arrays()
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        classes = list(zip(arrays["class_fclass"].tolist(), arrays["class_maxspeed"].tolist()))
+        return cls(arrays["offsets"], arrays["targets"], arrays["weights"],
+                   arrays["coords"], arrays["lonlat"],
+                   arrays.get("via_offsets"), arrays.get("via_nodes"),
+                   arrays["edge_class"], classes,
+                   (arrays["rev_offsets"], arrays["rev_sources"], arrays["rev_edges"]))
+
+
+class WeightedView:
+    """CSRGraph (or PatchedGraph) seen through per-class cost factors (see
+    profiles.py); shares all arrays."""
+
+    def __init__(self, graph, factors):
+        self.graph = graph
+        self.factors = np.asarray(factors, dtype=np.float64)
+        self.adj = graph.adjacency(self.factors)
+        finite = self.factors[np.isfinite(self.factors)]
+        # Cheapest cost per metre, so straight-line distance times it stays an A* lower bound
+        self.heuristic_scale = float(finite.min()) * graph.heuristic_scale if len(finite) else 0.0
+
+    @property
+    def radj(self):
+        return self.graph.reverse_adjacency(self.factors)
+
+    def expand_path(self, path):
+        return self.graph.expand_path(path, self.factors)
+
+    def path_length(self, path):
+        return self.graph.path_length(path, self.factors)
+
+    def __getattr__(self, name):
+        return getattr(self.graph, name)
+
+
+def _pass_through_nodes(G):
+    # A node is a pure shape point when it links exactly two other nodes,
+    # traffic can only go through it (a-v-b both ways, or a->v->b one way)
+    # and every edge touching it has the same road class.
+    n = G.num_nodes
+    out_deg = np.diff(G.offsets)
+    src = np.repeat(np.arange(n, dtype=np.int64), out_deg)
+    dst = G.targets.astype(np.int64)
+    in_deg = np.bincount(dst, minlength=n)
+    candidate = ((out_deg == 1) | (out_deg == 2)) & (out_deg == in_deg)
+    candidate[src[src == dst]] = False
+    cls = G.edge_class.astype(np.int64)
+    lo = np.full(n, np.iinfo(np.int64).max)
+    hi = np.full(n, -1, dtype=np.int64)
+    for ends in (src, dst):
+        np.minimum.at(lo, ends, cls)
+        np.maximum.at(hi, ends, cls)
+    candidate &= lo == hi
+
+    offsets, targets = G.offsets.tolist(), G.targets.tolist()
+    rev = {}
+    for u, v in zip(src.tolist(), dst.tolist()):
+        if candidate[v]:
+            rev.setdefault(v, []).append(u)
+    interior = np.zeros(n, dtype=bool)
+    for v in np.flatnonzero(candidate).tolist():
+        outs = targets[offsets[v]:offsets[v + 1]]
+        ins = rev.get(v, [])
+        if len(outs) == 2:
+            ok = outs[0] != outs[1] and sorted(outs) == sorted(ins)
+        else:
+            ok = outs[0] != ins[0]
+        interior[v] = ok
+    return interior
+
+
+# Contract chains of pass-through nodes into single edges. Node ids are
+# unchanged: interior nodes keep their coordinates but lose their edges, and
+# each new edge stores the chain it replaced so expand_path() restores it.
+def simplify_graph(G):
+    interior = _pass_through_nodes(G)
+    offsets, targets, weights = G.offsets.tolist(), G.targets.tolist(), G.weights.tolist()
+    edge_class = G.edge_class.tolist()
+    n = G.num_nodes
+
+    def walk(u, i):
+        prev, cur, w = u, targets[i], weights[i]
+        via = []
+        while interior[cur] and cur != u:
+            via.append(cur)
+            visited[cur] = True
+            a, b = offsets[cur], offsets[cur + 1]
+            j = a if b - a == 1 or targets[a] != prev else a + 1
+            prev, cur = cur, targets[j]
+            w += weights[j]
+        return cur, w, via
+
+    visited = np.zeros(n, dtype=bool)
+    rows = []
+    kept = np.flatnonzero(~interior).tolist()
+    while True:
+        for u in kept:
+            for i in range(offsets[u], offsets[u + 1]):
+                rows.append((u,) + walk(u, i) + (edge_class[i],))
+        # Closed rings made only of pass-through nodes: keep one node per ring
+        left = np.flatnonzero(interior & ~visited)
+        if len(left) == 0:
+            break
+        u = int(left[0])
+        interior[u] = False
+        visited[u] = True
+        kept = [u]
+
+    rows.sort(key=lambda r: r[0])
+    new_offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount([r[0] for r in rows], minlength=n), out=new_offsets[1:])
+    via_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(r[3]) for r in rows], out=via_offsets[1:])
+    via_nodes = np.fromiter((x for r in rows for x in r[3]), dtype=np.int32, count=int(via_offsets[-1]))
+    S = CSRGraph(new_offsets, np.array([r[1] for r in rows], dtype=np.int32),
+                 np.array([r[2] for r in rows], dtype=np.float64),
+                 G.coords, G.lonlat, via_offsets, via_nodes,
+                 np.array([r[4] for r in rows], dtype=G.edge_class.dtype), G.classes)
+
+    kept_nodes = int(n - interior.sum())
+    print(f"Simplified: nodes {n:,} -> {kept_nodes:,} ({100 * (1 - kept_nodes / max(n, 1)):.1f}% fewer), "
+          f"edges {G.num_edges:,} -> {S.num_edges:,} ({100 * (1 - S.num_edges / max(G.num_edges, 1)):.1f}% fewer)")
+    return S
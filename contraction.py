@@ -0,0 +1,320 @@
+import argparse
+import heapq
+import math
+import os
+import random
+import time
+
+import numpy as np
+
+from algorithms import dijkstra
+from graph_cache import load_or_build, read_arrays, write_arrays
+
+WITNESS_SETTLE_LIMIT = 60
+INF = float("inf")
+
+
+def default_ch_path(shp_path, simplify=False):
+    return os.path.splitext(shp_path)[0] + (".simple.rfch" if simplify else ".rfch")
+
+
+class _Builder:
+    def __init__(self, graph):
+        n = graph.num_nodes
+        self.n = n
+        self.out = [dict() for _ in range(n)]
+        self.inc = [dict() for _ in range(n)]
+        self.edge_dst = []
+        self.edge_child = []
+        for u in range(n):
+            for v, w, _ in graph.adj.get(u, []):
+                if u == v:
+                    continue
+                cur = self.out[u].get(v)
+                if cur is not None and cur[0] <= w:
+                    continue
+                eid = self._new_edge(v, -1, -1)
+                self.out[u][v] = (w, eid)
+                self.inc[v][u] = (w, eid)
+        self.rank = np.full(n, -1, dtype=np.int32)
+        self.deleted_neighbors = [0] * n
+        self.up = []
+        self.down = []
+
+    def _new_edge(self, dst, c1, c2):
+        self.edge_dst.append(dst)
+        self.edge_child.append((c1, c2))
+        return len(self.edge_dst) - 1
+
+    def _witness(self, src, skip, limit):
+        dist = {src: 0.0}
+        pq = [(0.0, src)]
+        settled = 0
+        out = self.out
+        while pq:
+            d, u = heapq.heappop(pq)
+            if d > dist[u]:
+                continue
+            if d > limit:
+                break
+            settled += 1
+            if settled > WITNESS_SETTLE_LIMIT:
+                break
+            for w, (wt, _) in out[u].items():
+                if w == skip:
+                    continue
+                nd = d + wt
+                if nd < dist.get(w, INF):
+                    dist[w] = nd
+                    heapq.heappush(pq, (nd, w))
+        return dist
+
+    def shortcuts(self, v):
+        outs = self.out[v]
+        found = []
+        if not outs:
+            return found
+        max_out = max(w for w, _ in outs.values())
+        for u, (wu, eu) in self.inc[v].items():
+            dist = self._witness(u, v, wu + max_out)
+            for w, (wv, ev) in outs.items():
+                if w == u:
+                    continue
+                via = wu + wv
+                if dist.get(w, INF) > via:
+                    found.append((u, w, via, eu, ev))
+        return found
+
+    def priority(self, v):
+        edge_diff = len(self.shortcuts(v)) - len(self.out[v]) - len(self.inc[v])
+        return edge_diff + self.deleted_neighbors[v]
+
+    def contract(self, v, order):
+        self.rank[v] = order
+        for w, (wt, eid) in self.out[v].items():
+            self.up.append((v, w, wt, eid))
+        for u, (wt, eid) in self.inc[v].items():
+            self.down.append((v, u, wt, eid))
+
+        for u, w, via, eu, ev in self.shortcuts(v):
+            cur = self.out[u].get(w)
+            if cur is not None and cur[0] <= via:
+                continue
+            eid = self._new_edge(w, eu, ev)
+            self.out[u][w] = (via, eid)
+            self.inc[w][u] = (via, eid)
+
+        neighbors = set(self.out[v]) | set(self.inc[v])
+        for w in self.out[v]:
+            del self.inc[w][v]
+        for u in self.inc[v]:
+            del self.out[u][v]
+        for x in neighbors:
+            self.deleted_neighbors[x] += 1
+        self.out[v] = {}
+        self.inc[v] = {}
+        return neighbors
+
+    def run(self):
+        heap = [(self.priority(v), v) for v in range(self.n)]
+        heapq.heapify(heap)
+        order = 0
+        while heap:
+            _, v = heapq.heappop(heap)
+            if self.rank[v] >= 0:
+                continue
+            # Lazy update: re-queue if the node got more expensive since it was pushed
+            p = self.priority(v)
+            if heap and p > heap[0][0]:
+                heapq.heappush(heap, (p, v))
+                continue
+            self.contract(v, order)
+            order += 1
+            if order % 100000 == 0:
+                print(f"  Contracted {order:,}/{self.n:,} nodes, edges={len(self.edge_dst):,}")
+        return order
+
+
+def _csr(n, rows):
+    rows.sort(key=lambda r: r[0])
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    if rows:
+        src = np.array([r[0] for r in rows], dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n), out=offsets[1:])
+    targets = np.array([r[1] for r in rows], dtype=np.int32)
+    weights = np.array([r[2] for r in rows], dtype=np.float64)
+    edges = np.array([r[3] for r in rows], dtype=np.int32)
+    return offsets, targets, weights, edges
+
+
+class ContractionHierarchy:
+    def __init__(self, rank, up, down, edge_dst, edge_child):
+        self.rank = rank
+        self.up_offsets, self.up_targets, self.up_weights, self.up_edges = up
+        self.down_offsets, self.down_targets, self.down_weights, self.down_edges = down
+        self.edge_dst = edge_dst
+        self.edge_child = edge_child
+
+    @classmethod
+    def build(cls, graph):
+        t0 = time.perf_counter()
+        b = _Builder(graph)
+        original = len(b.edge_dst)
+        b.run()
+        n = graph.num_nodes
+        print(f"CH built in {time.perf_counter() - t0:.1f}s: "
+              f"{original:,} edges + {len(b.edge_dst) - original:,} shortcuts")
+        return cls(b.rank, _csr(n, b.up), _csr(n, b.down),
+                   np.array(b.edge_dst, dtype=np.int32),
+                   np.array(b.edge_child, dtype=np.int32).reshape(-1, 2))
+
+    def to_arrays(self):
+        return {
+            "rank": self.rank,
+            "up_offsets": self.up_offsets, "up_targets": self.up_targets,
+            "up_weights": self.up_weights, "up_edges": self.up_edges,
+            "down_offsets": self.down_offsets, "down_targets": self.down_targets,
+            "down_weights": self.down_weights, "down_edges": self.down_edges,
+            "edge_dst": self.edge_dst, "edge_child": self.edge_child,
+        }
+
+    @classmethod
+    def from_arrays(cls, a):
+        return cls(a["rank"],
+                   (a["up_offsets"], a["up_targets"], a["up_weights"], a["up_edges"]),
+                   (a["down_offsets"], a["down_targets"], a["down_weights"], a["down_edges"]),
+                   a["edge_dst"], a["edge_child"])
+
+    def save(self, path, graph_key):
+        write_arrays(path, graph_key, self.to_arrays(), {"kind": "ch"})
+
+    @classmethod
+    def load(cls, path, graph_key):
+        loaded = read_arrays(path, graph_key)
+        if loaded is None:
+            return None
+        return cls.from_arrays(loaded[1])
+
+    def _unpack(self, eid, out):
+        stack = [eid]
+        while stack:
+            e = stack.pop()
+            c1, c2 = self.edge_child[e].tolist()
+            if c1 < 0:
+                out.append(int(self.edge_dst[e]))
+            else:
+                stack.append(c2)
+                stack.append(c1)
+
+    def query(self, start, goal, stats=None):
+        if start == goal:
+            if stats is not None:
+                stats["settled"] = 0
+            return [start], 0.0
+        graphs = (
+            (self.up_offsets, self.up_targets, self.up_weights, self.up_edges),
+            (self.down_offsets, self.down_targets, self.down_weights, self.down_edges),
+        )
+        dist = ({start: 0.0}, {goal: 0.0})
+        via = ({}, {})
+        pq = ([(0.0, start)], [(0.0, goal)])
+        best, meet = INF, None
+        popped = settled = relaxed = pushes = 0
+        while pq[0] or pq[1]:
+            if not pq[1] or (pq[0] and pq[0][0][0] <= pq[1][0][0]):
+                side = 0
+            else:
+                side = 1
+            d, node = heapq.heappop(pq[side])
+            popped += 1
+            if d >= best:
+                # Both searches only climb in rank, so this side cannot improve
+                pq[side].clear()
+                continue
+            if d > dist[side].get(node, INF):
+                continue
+            settled += 1
+            other = dist[1 - side].get(node)
+            if other is not None and d + other < best:
+                best, meet = d + other, node
+            offsets, targets, weights, edges = graphs[side]
+            a, b = int(offsets[node]), int(offsets[node + 1])
+            relaxed += b - a
+            for neigh, w, eid in zip(targets[a:b].tolist(), weights[a:b].tolist(), edges[a:b].tolist()):
+                nd = d + w
+                if nd < dist[side].get(neigh, INF):
+                    dist[side][neigh] = nd
+                    via[side][neigh] = (node, eid)
+                    heapq.heappush(pq[side], (nd, neigh))
+                    pushes += 1
+        if stats is not None:
+            stats["settled"] = settled
+            stats.update(popped=popped, relaxed=relaxed, pushes=pushes + 2)
+        if meet is None:
+            return None, INF
+
+        head = []
+        cur = meet
+        while cur != start:
+            cur, eid = via[0][cur]
+            head.append(eid)
+        path = [start]
+        for eid in reversed(head):
+            self._unpack(eid, path)
+        cur = meet
+        while cur != goal:
+            cur, eid = via[1][cur]
+            self._unpack(eid, path)
+        return path, best
+
+
+def validate(graph, ch, pairs=200, seed=0):
+    # Only nodes with roads; on a simplified graph most ids are chain interiors
+    nodes = graph.routable_nodes().tolist()
+    rng = random.Random(seed)
+    bad = 0
+    for _ in range(pairs):
+        s, t = rng.choice(nodes), rng.choice(nodes)
+        _, expected = dijkstra(graph, s, t)
+        path, got = ch.query(s, t)
+        ok = (expected == got) or math.isclose(expected, got, rel_tol=1e-9)
+        if ok and path is not None:
+            ok = path[0] == s and path[-1] == t and math.isclose(
+                sum(min(w for v, w, _ in graph.adj.get(a, []) if v == b) for a, b in zip(path, path[1:])),
+                got, rel_tol=1e-9, abs_tol=1e-6)
+        if not ok:
+            bad += 1
+            print(f"  mismatch s={s} t={t} dijkstra={expected} ch={got}")
+    print(f"Validated {pairs} pairs: {pairs - bad} ok, {bad} mismatched")
+    return bad == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Contraction Hierarchies preprocessing")
+    parser.add_argument("cmd", choices=["build", "validate"])
+    parser.add_argument("--shp", default=os.environ.get("OSM_SHP", "mongolia-251026-free/gis_osm_roads_free_1.shp"))
+    parser.add_argument("--out", default=os.environ.get("OSM_CH"))
+    parser.add_argument("--pairs", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--simplify", action="store_true", help="use the degree-2 simplified graph")
+    args = parser.parse_args()
+
+    hash_source = os.environ.get("OSM_CACHE_HASH") == "1"
+    simplify = args.simplify or os.environ.get("OSM_SIMPLIFY") == "1"
+    graph, _, key = load_or_build(args.shp, cache_path=os.environ.get("OSM_GRAPH_CACHE"),
+                                  hash_source=hash_source, simplify=simplify)
+    out = args.out or default_ch_path(args.shp, simplify)
+    if args.cmd == "build":
+        ch = ContractionHierarchy.build(graph)
+        ch.save(out, key)
+        print("Saved:", out)
+        validate(graph, ch, pairs=min(args.pairs, 50), seed=args.seed)
+    else:
+        ch = ContractionHierarchy.load(out, key)
+        if ch is None:
+            raise SystemExit(f"no CH for the current graph at {out}, run: python contraction.py build")
+        raise SystemExit(0 if validate(graph, ch, args.pairs, args.seed) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import numpy as np
+
+
+def _encode_value(v, out):
+    v = ~(v << 1) if v < 0 else v << 1
+    while v >= 0x20:
+        out.append(chr((0x20 | (v & 0x1F)) + 63))
+        v >>= 5
+    out.append(chr(v + 63))
+
+
+def encode_polyline(lonlat, precision=5):
+    # Google encoded polyline; pairs are written lat first like every decoder expects
+    factor = 10 ** precision
+    out = []
+    plat = plon = 0
+    for lon, lat in lonlat:
+        ilat = int(round(lat * factor))
+        ilon = int(round(lon * factor))
+        _encode_value(ilat - plat, out)
+        _encode_value(ilon - plon, out)
+        plat, plon = ilat, ilon
+    return "".join(out)
+
+
+def decode_polyline(text, precision=5):
+    factor = 10 ** precision
+    coords = []
+    i = lat = lon = 0
+    while i < len(text):
+        vals = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                b = ord(text[i]) - 63
+                i += 1
+                result |= (b & 0x1F) << shift
+                shift += 5
+                if b < 0x20:
+                    break
+            vals.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += vals[0]
+        lon += vals[1]
+        coords.append((lon / factor, lat / factor))
+    return coords
+
+
+def delta_encode(lonlat, precision=6):
+    # Flat [lon0, lat0, dlon1, dlat1, ...] in integer units of 10^-precision degrees
+    if not lonlat:
+        return []
+    q = np.round(np.asarray(lonlat, dtype=np.float64) * 10 ** precision).astype(np.int64)
+    q[1:] -= q[:-1].copy()
+    return q.reshape(-1).tolist()
+
+
+def douglas_peucker(xy, tolerance):
+    """Indices of the points kept when simplifying xy (an (n, 2) array) to tolerance."""
+    xy = np.asarray(xy, dtype=np.float64)
+    n = len(xy)
+    if n < 3 or tolerance <= 0:
+        return np.arange(n)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+        p, q = xy[a], xy[b]
+        seg = q - p
+        pts = xy[a + 1:b] - p
+        seg_len = np.hypot(seg[0], seg[1])
+        if seg_len == 0:
+            d = np.hypot(pts[:, 0], pts[:, 1])
+        else:
+            d = np.abs(pts[:, 0] * seg[1] - pts[:, 1] * seg[0]) / seg_len
+        i = int(np.argmax(d))
+        if d[i] > tolerance:
+            m = a + 1 + i
+            keep[m] = True
+            stack.append((a, m))
+            stack.append((m, b))
+    return np.flatnonzero(keep)
@@ -0,0 +1,197 @@
+import hashlib
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+from pyproj import CRS
+
+from build_graph import SNAP_TOLERANCE, CSRGraph, build_graph_vectorized, simplify_graph
+from spatial_index import GridIndex
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CACHE_VERSION = 5
+MAGIC = b"RFGRAPH\x00"
+ALIGN = 64
+SHP_SIDECARS = (".shp", ".shx", ".dbf", ".prj", ".cpg")
+
+
+def default_cache_path(shp_path):
+    return os.path.splitext(shp_path)[0] + ".rfgraph"
+
+
+def source_fingerprint(shp_path, hash_source=False):
+    stem = os.path.splitext(shp_path)[0]
+    parts = []
+    for ext in SHP_SIDECARS:
+        p = stem + ext
+        if not os.path.exists(p):
+            continue
+        if hash_source:
+            h = hashlib.sha256()
+            with open(p, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+            parts.append([ext, h.hexdigest()])
+        else:
+            st = os.stat(p)
+            parts.append([ext, st.st_size, st.st_mtime_ns])
+    return parts
+
+
+def cache_key(shp_path, target_epsg=3857, tol=SNAP_TOLERANCE, hash_source=False, simplify=False, source=None):
+    # source: a source_fingerprint already taken, so the shapefile is hashed once
+    ident = {
+        "version": CACHE_VERSION,
+        "source": source if source is not None else source_fingerprint(shp_path, hash_source),
+        "tol": tol,
+        "epsg": target_epsg,
+        "simplify": simplify,
+    }
+    return hashlib.sha256(json.dumps(ident, sort_keys=True).encode()).hexdigest()
+
+
+def _pad(n):
+    return (-n) % ALIGN
+
+
+def write_arrays(path, key, arrays, meta=None):
+    layout = {}
+    offset = 0
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        arrays[name] = arr
+        layout[name] = [arr.dtype.str, list(arr.shape), offset]
+        offset += arr.nbytes + _pad(arr.nbytes)
+    header = json.dumps({"key": key, "meta": meta or {}, "arrays": layout}).encode()
+    prefix = len(MAGIC) + 8 + len(header)
+    data_start = prefix + _pad(prefix)
+
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<II", CACHE_VERSION, len(header)))
+        f.write(header)
+        f.write(b"\x00" * (data_start - prefix))
+        for name, arr in arrays.items():
+            f.write(arr.tobytes())
+            f.write(b"\x00" * _pad(arr.nbytes))
+    os.replace(tmp, path)
+
+
+def read_arrays(path, key=None):
+    if not os.path.exists(path):
+        return None
+    mm = np.memmap(path, dtype=np.uint8, mode="r")
+    if bytes(mm[:len(MAGIC)]) != MAGIC:
+        return None
+    version, header_len = struct.unpack("<II", bytes(mm[len(MAGIC):len(MAGIC) + 8]))
+    if version != CACHE_VERSION:
+        return None
+    start = len(MAGIC) + 8
+    header = json.loads(bytes(mm[start:start + header_len]))
+    if key is not None and header["key"] != key:
+        return None
+    prefix = start + header_len
+    data_start = prefix + _pad(prefix)
+    arrays = {}
+    for name, (dtype, shape, offset) in header["arrays"].items():
+        dt = np.dtype(dtype)
+        a = data_start + offset
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dt.itemsize
+        arrays[name] = mm[a:a + nbytes].view(dt).reshape(shape)
+    return header["meta"], arrays
+
+
+def save_graph(path, G, crs, key):
+    if G.index is None:
+        G.index = GridIndex.build(G.coords, G.routable_nodes())
+    arrays = {**G.to_arrays(), **G.index.to_arrays()}
+    write_arrays(path, key, arrays, {"crs": crs.to_wkt(), "index": G.index.meta()})
+
+
+def load_graph(path, key):
+    loaded = read_arrays(path, key)
+    if loaded is None:
+        return None
+    meta, arrays = loaded
+    G = CSRGraph.from_arrays(arrays)
+    G.index = GridIndex.from_arrays(G.coords, arrays, meta["index"])
+    return G, CRS.from_wkt(meta["crs"])
+
+
+class _BuildLock:
+    def __init__(self, path):
+        self.path = path + ".lock"
+        self.f = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self.f = open(self.path, "w")
+            fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self.f is not None:
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+            self.f.close()
+
+
+def load_or_build(shp_path, target_epsg=3857, cache_path=None, hash_source=False, simplify=False):
+    """(graph, crs, key); key is the cache key the graph was loaded under, which
+    the CH and other files built for this graph are checked against."""
+    source = source_fingerprint(shp_path, hash_source)
+    if simplify:
+        return _load_or_build_simple(shp_path, target_epsg, cache_path, source)
+    return _load_or_build_full(shp_path, target_epsg, cache_path, source)
+
+
+def _load_or_build_full(shp_path, target_epsg, cache_path, source):
+    cache_path = cache_path or default_cache_path(shp_path)
+    key = cache_key(shp_path, target_epsg, SNAP_TOLERANCE, source=source)
+
+    loaded = load_graph(cache_path, key)
+    if loaded is not None:
+        print("Graph cache hit:", cache_path)
+        return (*loaded, key)
+
+    # One worker builds, the others wait on the lock and then map the result
+    with _BuildLock(cache_path):
+        loaded = load_graph(cache_path, key)
+        if loaded is not None:
+            print("Graph cache hit:", cache_path)
+            return (*loaded, key)
+        print("Graph cache miss, building:", cache_path)
+        G, crs = build_graph_vectorized(shp_path, target_epsg=target_epsg)
+        save_graph(cache_path, G, crs, key)
+    return (*load_graph(cache_path, key), key)
+
+
+def _load_or_build_simple(shp_path, target_epsg, cache_path, source):
+    full_path = cache_path or default_cache_path(shp_path)
+    simple_path = os.path.splitext(full_path)[0] + ".simple.rfgraph"
+    key = cache_key(shp_path, target_epsg, SNAP_TOLERANCE, simplify=True, source=source)
+    loaded = load_graph(simple_path, key)
+    if loaded is not None:
+        print("Graph cache hit:", simple_path)
+        return (*loaded, key)
+    G, crs, _ = _load_or_build_full(shp_path, target_epsg, full_path, source)
+    with _BuildLock(simple_path):
+        loaded = load_graph(simple_path, key)
+        if loaded is not None:
+            return (*loaded, key)
+        print("Graph cache miss, simplifying:", simple_path)
+        save_graph(simple_path, simplify_graph(G), crs, key)
+    return (*load_graph(simple_path, key), key)
+
+
+if __name__ == "__main__":
+    shp = sys.argv[1] if len(sys.argv) > 1 else "mongolia-251026-free/gis_osm_roads_free_1.shp"
+    G, crs, _ = load_or_build(shp, cache_path=os.environ.get("OSM_GRAPH_CACHE"),
+                           simplify=os.environ.get("OSM_SIMPLIFY") == "1")
+    print(f"nodes={G.num_nodes:,} edges={G.num_edges:,} crs={crs.to_string()}")
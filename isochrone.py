@@ -0,0 +1,61 @@
+import numpy as np
+import shapely
+from pyproj import Transformer
+from shapely.geometry import Polygon, mapping
+
+from algorithms import dijkstra_within
+
+SHAPES = ("hull", "grid")
+
+
+def reach(graph, sources, limits, stats=None):
+    """One bounded search for the largest limit; returns (nodes, costs) arrays of
+    everything reached, so each smaller limit is just a mask."""
+    dist = dijkstra_within(graph, sources, max(limits), stats=stats)
+    nodes = np.fromiter(dist.keys(), dtype=np.int64, count=len(dist))
+    costs = np.fromiter(dist.values(), dtype=np.float64, count=len(dist))
+    return nodes, costs
+
+
+def _hull(xy, ratio, cell):
+    geom = shapely.concave_hull(shapely.multipoints(xy), ratio=ratio)
+    if not isinstance(geom, Polygon) or geom.is_empty:
+        # One or two reachable nodes, or all in a line
+        geom = geom.buffer(cell / 2)
+    return geom
+
+
+def _grid(xy, cell):
+    cells = np.unique(np.floor(xy / cell).astype(np.int64), axis=0) * cell
+    boxes = shapely.box(cells[:, 0], cells[:, 1], cells[:, 0] + cell, cells[:, 1] + cell)
+    return shapely.coverage_union_all(boxes)
+
+
+def polygons(coords, costs, limits, shape="hull", cell=250.0, ratio=0.3):
+    """One polygon (graph CRS) per limit around the nodes reached within it."""
+    out = []
+    for limit in limits:
+        xy = coords[costs <= limit]
+        if shape == "grid":
+            out.append(_grid(xy, cell))
+        else:
+            out.append(_hull(xy, ratio, cell))
+    return out
+
+
+def to_geojson(geoms, limits, counts, graph_crs, unit, simplify=None):
+    to_wgs84 = Transformer.from_crs(graph_crs.to_string(), "EPSG:4326", always_xy=True)
+
+    def lonlat(xy):
+        return np.round(np.column_stack(to_wgs84.transform(xy[:, 0], xy[:, 1])), 6)
+
+    features = []
+    for geom, limit, count in zip(geoms, limits, counts):
+        if simplify:
+            geom = shapely.simplify(geom, simplify)
+        features.append({
+            "type": "Feature",
+            "properties": {unit: limit, "nodes": int(count)},
+            "geometry": mapping(shapely.transform(geom, lonlat)),
+        })
+    return {"type": "FeatureCollection", "features": features}
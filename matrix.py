@@ -0,0 +1,111 @@
+import multiprocessing
+import os
+import threading
+
+from algorithms import _trace, dijkstra_one_to_many
+
+# Set once in each pool worker by _init_worker; workers are single-threaded
+_WORKER_GRAPH = None
+_WORKER_VIEWS = {}
+
+
+def _row(graph, source, targets, with_paths):
+    stats = {}
+    dists, prev = dijkstra_one_to_many(graph, source, targets, stats=stats)
+    row = [dists[t] for t in targets]
+    paths = None
+    if with_paths:
+        paths = [_trace(prev, source, t) if d != float("inf") else None for t, d in zip(targets, row)]
+    return row, paths, stats["settled"]
+
+
+def _init_worker(graph):
+    global _WORKER_GRAPH
+    _WORKER_GRAPH = graph
+
+
+def _pool_row(job):
+    factors, source, targets, with_paths = job
+    graph = _WORKER_GRAPH
+    if factors is not None:
+        key = factors.tobytes()
+        if key not in _WORKER_VIEWS:
+            _WORKER_VIEWS[key] = graph.weighted(factors)
+        graph = _WORKER_VIEWS[key]
+    return _row(graph, source, targets, with_paths)
+
+
+def _fork_context():
+    try:
+        return multiprocessing.get_context("fork")
+    except ValueError:
+        return None
+
+
+def default_workers():
+    # Opt-in: every server worker forks its own pool, so N gunicorn workers
+    # with MATRIX_WORKERS=k run N * k searcher processes
+    return int(os.environ.get("MATRIX_WORKERS", 1))
+
+
+class MatrixPool:
+    """Worker processes forked from a process holding the base graph, which they
+    share through the memory map. Requests on that graph, or on a weighted view
+    of it, run there; the view is rebuilt in the worker from its factors.
+
+    The pool is forked on first use, once per process, so importing the app
+    (or a server worker that never serves /matrix) starts nothing."""
+
+    def __init__(self, graph, workers):
+        self.graph = graph
+        self.workers = workers
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # One fork at a time, however many request threads get here together
+        ctx = _fork_context()
+        if ctx is None or self.workers < 2:
+            return self
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pool = ctx.Pool(self.workers, initializer=_init_worker, initargs=(self.graph,))
+                self._pid = os.getpid()
+        return self
+
+    def factors_for(self, graph):
+        """(True, factors or None) when graph can run in the pool."""
+        if self.workers < 2 or _fork_context() is None:
+            return False, None
+        if graph is self.graph:
+            return True, None
+        if getattr(graph, "graph", None) is self.graph and getattr(graph, "factors", None) is not None:
+            return True, graph.factors
+        return False, None
+
+    def map(self, jobs):
+        if self._pid != os.getpid():
+            self.start()
+        return self._pool.map(_pool_row, jobs)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.terminate()
+            self._pool = self._pid = None
+
+
+def distance_matrix(graph, sources, targets, pool=None, with_paths=False):
+    # One multi-target search per source, on the graph that is passed in.
+    # Rows go to the pool only when it was forked from that same graph.
+    targets = list(targets)
+    usable, factors = pool.factors_for(graph) if pool is not None else (False, None)
+    if usable and len(sources) > 1:
+        rows = pool.map([(factors, s, targets, with_paths) for s in sources])
+    else:
+        rows = [_row(graph, s, targets, with_paths) for s in sources]
+    distances = [r[0] for r in rows]
+    paths = [r[1] for r in rows] if with_paths else None
+    settled = sum(r[2] for r in rows)
+    return distances, paths, settled
@@ -0,0 +1,179 @@
+import cProfile
+import io
+import pstats
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Seconds; the last bucket is +Inf
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Search counters (see algorithms._count) exported per algorithm
+SEARCH_COUNTERS = {
+    "popped": "Queue or stack entries taken",
+    "settled": "Nodes expanded",
+    "relaxed": "Edges looked at from expanded nodes",
+    "pushes": "Heap pushes",
+    "cap_hits": "Searches stopped by an iteration or node cap",
+}
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    inner = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                     for k, v in labels)
+    return "{" + inner + "}"
+
+
+def _num(v):
+    return repr(float(v)) if v != int(v) else str(int(v))
+
+
+class Metrics:
+    """Counters, gauges and histograms for one process, in the Prometheus text format."""
+
+    def __init__(self, prefix="routefinder"):
+        self.prefix = prefix
+        self._help = {}
+        self._counters = defaultdict(float)
+        self._gauges = {}
+        self._hists = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        self._help[self.prefix + "_" + name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (self.prefix + "_" + name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def set(self, name, value, **labels):
+        key = (self.prefix + "_" + name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (self.prefix + "_" + name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._hists.get(key)
+            if h is None:
+                h = self._hists[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+            i = 0
+            while i < len(BUCKETS) and seconds > BUCKETS[i]:
+                i += 1
+            h[0][i] += 1
+            h[1] += seconds
+
+    def record_search(self, algorithm, stats):
+        self.inc("searches_total", algorithm=algorithm)
+        for name in SEARCH_COUNTERS:
+            if stats.get(name):
+                self.inc(f"search_{name}_total", stats[name], algorithm=algorithm)
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            hists = sorted((k, (list(b), s)) for k, (b, s) in self._hists.items())
+        lines = []
+        described = set()
+
+        def head(name, default_kind):
+            if name in described:
+                return
+            described.add(name)
+            kind, text = self._help.get(name, (default_kind, ""))
+            if text:
+                lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            head(name, "counter")
+            lines.append(f"{name}{_labels(labels)} {_num(value)}")
+        for (name, labels), value in gauges:
+            head(name, "gauge")
+            lines.append(f"{name}{_labels(labels)} {_num(value)}")
+        for (name, labels), (buckets, total) in hists:
+            head(name, "histogram")
+            cum = 0
+            for le, n in zip(BUCKETS + (float("inf"),), buckets):
+                cum += n
+                bound = "+Inf" if le == float("inf") else repr(le)
+                lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cum}")
+            lines.append(f"{name}_sum{_labels(labels)} {total!r}")
+            lines.append(f"{name}_count{_labels(labels)} {cum}")
+        return "\n".join(lines) + "\n"
+
+
+class Timing:
+    """Wall time per phase of one request, in the order the phases ran."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - t0
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def as_dict(self):
+        out = {k: round(v * 1000, 3) for k, v in self.phases.items()}
+        out["total"] = round(self.elapsed() * 1000, 3)
+        return out
+
+
+class SamplingProfiler:
+    """cProfile around a random share of requests (rate in percent, changeable at
+    runtime). Profiles add up until reset. One request is profiled at a time,
+    since cProfile cannot nest."""
+
+    def __init__(self, rate=0.0):
+        self.rate = rate
+        self.sampled = 0
+        self._stats = None
+        self._busy = threading.Lock()
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.rate <= 0 or random.random() * 100 >= self.rate:
+            return None
+        if not self._busy.acquire(blocking=False):
+            return None
+        prof = cProfile.Profile()
+        prof.enable()
+        return prof
+
+    def stop(self, prof):
+        prof.disable()
+        self._busy.release()
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(prof)
+            else:
+                self._stats.add(prof)
+            self.sampled += 1
+
+    def reset(self):
+        with self._lock:
+            self._stats = None
+            self.sampled = 0
+
+    def report(self, sort="cumulative", limit=40):
+        with self._lock:
+            if self._stats is None:
+                return "no requests profiled yet\n"
+            out = io.StringIO()
+            self._stats.stream = out
+            self._stats.sort_stats(sort).print_stats(limit)
+        return f"{self.sampled} requests profiled\n" + out.getvalue()
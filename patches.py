@@ -0,0 +1,436 @@
+import json
+import os
+import time
+import uuid
+from itertools import repeat
+
+import geopandas as gpd
+import numpy as np
+from pyproj import Transformer
+
+from algorithms import dijkstra
+from build_graph import SNAP_TOLERANCE, WeightedView, _NodeRows, crs_scales, read_roads, road_segments
+from spatial_index import OverlayIndex
+
+
+class PatchError(ValueError):
+    pass
+
+
+class PatchSet:
+    """Changes applied on top of the base graph, all in node ids.
+
+    Added nodes get ids after the base graph's, in the order they were added."""
+
+    def __init__(self, base_nodes):
+        self.base_nodes = base_nodes
+        self.blocked = set()
+        self.weights = {}
+        self.nodes = []  # (x, y, lon, lat)
+        self.edges = []  # (u, v, length, fclass, maxspeed)
+
+    @property
+    def next_node(self):
+        return self.base_nodes + len(self.nodes)
+
+    @property
+    def active(self):
+        return bool(self.blocked or self.weights or self.edges)
+
+    def copy(self):
+        out = PatchSet(self.base_nodes)
+        out.blocked = set(self.blocked)
+        out.weights = dict(self.weights)
+        out.nodes = list(self.nodes)
+        out.edges = list(self.edges)
+        return out
+
+    def apply(self, patch):
+        add = patch.get("add")
+        if add and add["first_node"] != self.next_node:
+            raise PatchError(f"patch adds nodes from id {add['first_node']}, graph is at {self.next_node}")
+        self.blocked.update(map(tuple, patch.get("block", ())))
+        self.blocked.difference_update(map(tuple, patch.get("unblock", ())))
+        for u, v, w in patch.get("weights", ()):
+            self.weights[(u, v)] = w
+        if add:
+            self.nodes.extend(map(tuple, add["nodes"]))
+            self.edges.extend(map(tuple, add["edges"]))
+
+    def summary(self):
+        return {"blocked": len(self.blocked), "weights": len(self.weights),
+                "added_nodes": len(self.nodes), "added_edges": len(self.edges)}
+
+
+def _base_edges(base, u, v):
+    if not 0 <= u < base.num_nodes:
+        return np.empty(0, dtype=np.int64)
+    a = int(base.offsets[u])
+    return np.flatnonzero(base.targets[a:int(base.offsets[u + 1])] == v) + a
+
+
+class _PatchedAdjacency:
+    """Edges of one direction: the base CSR slice minus blocked edges, with
+    changed weights, plus the added roads at that node."""
+
+    def __init__(self, num_nodes, offsets, targets, weights, edge_class, open_, extra, factors=None,
+                 edge_ids=None):
+        self.num_nodes = num_nodes
+        self.edge_ids = edge_ids
+        self.offsets = offsets
+        self.targets = targets
+        self.weights = weights
+        self.edge_class = edge_class
+        self.open = open_
+        self.extra = extra
+        self.factors = factors
+
+    def get(self, node, default=None):
+        if node < 0 or node >= self.num_nodes:
+            return default
+        out = []
+        if node < len(self.offsets) - 1:
+            a, b = int(self.offsets[node]), int(self.offsets[node + 1])
+            e = slice(a, b) if self.edge_ids is None else self.edge_ids[a:b]
+            w = self.weights[e]
+            keep = self.open[e] if self.open is not None else None
+            if self.factors is not None:
+                w = w * self.factors[self.edge_class[e]]
+                keep = np.isfinite(w) if keep is None else keep & np.isfinite(w)
+            targets = self.targets[a:b]
+            if keep is not None:
+                targets, w = targets[keep], w[keep]
+            out = list(zip(targets.tolist(), w.tolist(), repeat(None, len(w))))
+        for v, w, c in self.extra.get(node, ()):
+            if self.factors is not None:
+                w = w * self.factors[c]
+                if not np.isfinite(w):
+                    continue
+            out.append((v, w, None))
+        return out
+
+    def __getitem__(self, node):
+        return self.get(node, [])
+
+    def __len__(self):
+        return self.num_nodes
+
+
+class PatchedGraph:
+    """The base CSRGraph with a PatchSet on top, without copying its arrays.
+
+    Blocked base edges are a mask and changed weights an override array over
+    the base edges; only added roads get nodes and edges of their own."""
+
+    def __init__(self, base, ps):
+        n0 = base.num_nodes
+        self.base = base
+        self.num_nodes = ps.next_node
+        self.classes = list(base.classes)
+        self.via_offsets = base.via_offsets
+
+        self.open = None
+        if ps.blocked:
+            blocked = np.zeros(base.num_edges, dtype=bool)
+            for u, v in ps.blocked:
+                blocked[_base_edges(base, u, v)] = True
+            self.open = ~blocked
+            self.open.flags.writeable = False
+        self.weights = base.weights
+        changed = []  # (u, v, weight) of edges that may now be cheaper per metre
+        if ps.weights:
+            self.weights = base.weights.copy()
+            for (u, v), w in ps.weights.items():
+                self.weights[_base_edges(base, u, v)] = w
+                changed.append((u, v, w))
+            self.weights.flags.writeable = False
+
+        class_id = {c: i for i, c in enumerate(self.classes)}
+        self.extra, self.rextra = {}, {}
+        added = 0
+        for u, v, length, fclass, maxspeed in ps.edges:
+            if (u, v) in ps.blocked:
+                continue
+            c = (fclass, maxspeed)
+            if c not in class_id:
+                class_id[c] = len(self.classes)
+                self.classes.append(c)
+            w = ps.weights.get((u, v), length)
+            self.extra.setdefault(u, []).append((v, w, class_id[c]))
+            self.rextra.setdefault(v, []).append((u, w, class_id[c]))
+            changed.append((u, v, w))
+            added += 1
+        self.num_edges = base.num_edges - (int((~self.open).sum()) if self.open is not None else 0) + added
+
+        self.coords, self.lonlat = base.coords, base.lonlat
+        if ps.nodes:
+            nodes = np.array(ps.nodes, dtype=np.float64)
+            self.coords = np.vstack([base.coords, nodes[:, :2]])
+            self.lonlat = np.vstack([base.lonlat, nodes[:, 2:]])
+        self.node_coords = _NodeRows(self.coords)
+        self.node_lonlat = _NodeRows(self.lonlat)
+        self.adj = self.adjacency()
+
+        self.heuristic_scale = base.heuristic_scale
+        if changed:
+            uv = np.array([(u, v) for u, v, _ in changed], dtype=np.int64)
+            chord = np.hypot(*(self.coords[uv[:, 1]] - self.coords[uv[:, 0]]).T)
+            ok = chord > 0
+            if ok.any():
+                w = np.array([w for _, _, w in changed], dtype=np.float64)
+                self.heuristic_scale = min(self.heuristic_scale, float((w[ok] / chord[ok]).min()))
+
+        # Only the ends of blocked edges can lose their last road
+        ends = {n for p in ps.blocked for n in p if n < n0}
+        self.hidden = sorted(n for n in ends if not self._has_edge(n))
+        self.added_nodes = np.array(sorted(set(self.extra) | set(self.rextra)), dtype=np.int64)
+        self.index = OverlayIndex(base.index, self.coords, self.added_nodes[self.added_nodes >= n0], self.hidden)
+
+    def _has_edge(self, node):
+        if node in self.extra or node in self.rextra:
+            return True
+        base = self.base
+        a, b = int(base.offsets[node]), int(base.offsets[node + 1])
+        if self.open[a:b].any():
+            return True
+        r_offsets, _, edge_ids = base.reverse_arrays()
+        return bool(self.open[edge_ids[int(r_offsets[node]):int(r_offsets[node + 1])]].any())
+
+    def adjacency(self, factors=None):
+        base = self.base
+        return _PatchedAdjacency(self.num_nodes, base.offsets, base.targets, self.weights, base.edge_class,
+                                 self.open, self.extra, factors)
+
+    def reverse_adjacency(self, factors=None):
+        # The base reverse CSR points at forward edges, so the mask and weights apply as they are
+        offsets, sources, edge_ids = self.base.reverse_arrays()
+        return _PatchedAdjacency(self.num_nodes, offsets, sources, self.weights, self.base.edge_class,
+                                 self.open, self.rextra, factors, edge_ids)
+
+    @property
+    def radj(self):
+        return self.reverse_adjacency()
+
+    def weighted(self, factors):
+        return WeightedView(self, factors)
+
+    def routable_nodes(self):
+        nodes = self.base.routable_nodes()
+        if self.hidden:
+            nodes = np.setdiff1d(nodes, self.hidden, assume_unique=True)
+        return np.union1d(nodes, self.added_nodes)
+
+    def _edge_between(self, u, v, factors=None):
+        # (weight, base edge index or None) of the cheapest open edge u -> v
+        best, best_w, best_cost = None, None, float("inf")
+        if u < self.base.num_nodes:
+            for i in _base_edges(self.base, u, v).tolist():
+                if self.open is not None and not self.open[i]:
+                    continue
+                w = float(self.weights[i])
+                cost = w if factors is None else w * factors[self.base.edge_class[i]]
+                if cost < best_cost:
+                    best, best_w, best_cost = i, w, cost
+        for t, w, c in self.extra.get(u, ()):
+            cost = w if factors is None else w * factors[c]
+            if t == v and cost < best_cost:
+                best, best_w, best_cost = None, w, cost
+        return best_w, best
+
+    def expand_path(self, path, factors=None):
+        if self.via_offsets is None or not path:
+            return path
+        via_offsets, via_nodes = self.base.via_offsets, self.base.via_nodes
+        out = [path[0]]
+        for u, v in zip(path, path[1:]):
+            _, e = self._edge_between(u, v, factors)
+            if e is not None:
+                out.extend(via_nodes[via_offsets[e]:via_offsets[e + 1]].tolist())
+            out.append(v)
+        return out
+
+    def path_length(self, path, factors=None):
+        return float(sum(self._edge_between(u, v, factors)[0] for u, v in zip(path, path[1:])))
+
+
+def _edge_weight(graph, u, v):
+    if not 0 <= u < graph.num_nodes:
+        return None
+    ws = [w for neigh, w, _ in graph.adj.get(u, []) if neigh == v]
+    return min(ws) if ws else None
+
+
+class _Resolver:
+    def __init__(self, graph, base, ps, graph_crs, snap):
+        self.graph = graph
+        self.base = base
+        self.ps = ps
+        self.crs = graph_crs
+        self.snap = snap
+        self.to_graph = Transformer.from_crs("EPSG:4326", graph_crs.to_string(), always_xy=True)
+        self.touched = []
+
+    def nodes(self, item, search_graph):
+        # "nodes": [u, v, ...] are used as given; "from"/"to" points are snapped
+        # and joined by the shortest path, so a whole stretch of road can be named.
+        if "nodes" in item:
+            nodes = [int(n) for n in item["nodes"]]
+        elif "from" in item and "to" in item:
+            (x1, x2), (y1, y2) = self.to_graph.transform([item["from"][0], item["to"][0]],
+                                                         [item["from"][1], item["to"][1]])
+            u, v = self.graph.index.nearest(x1, y1), self.graph.index.nearest(x2, y2)
+            nodes, _ = dijkstra(search_graph, u, v)
+            if nodes is None:
+                raise PatchError(f"no road between {item['from']} and {item['to']}")
+        else:
+            raise PatchError("edge needs 'nodes' or 'from' and 'to'")
+        if len(nodes) < 2:
+            raise PatchError(f"edge {item} resolves to a single node")
+        return nodes
+
+    def pairs(self, item, search_graph, exists):
+        nodes = self.nodes(item, search_graph)
+        out = []
+        for u, v in zip(nodes, nodes[1:]):
+            for p in ((u, v), (v, u)) if item.get("both", True) else ((u, v),):
+                if exists(p):
+                    out.append(p)
+        if not out:
+            raise PatchError(f"no matching edge for {item}")
+        self.touched.extend(n for p in out for n in p)
+        return out
+
+    def original_length(self, u, v):
+        w = _edge_weight(self.base, u, v)
+        if w is None:
+            w = min((e[2] for e in self.ps.edges if e[0] == u and e[1] == v), default=None)
+        return w
+
+    def add(self, body):
+        if self.base.via_offsets is not None:
+            raise PatchError("adding roads needs the full graph (OSM_SIMPLIFY=0)")
+        if "add_file" in body:
+            gdf = read_roads(body["add_file"], self.crs.to_epsg())
+        else:
+            gdf = gpd.GeoDataFrame.from_features(body["add"], crs="EPSG:4326").to_crs(self.crs)
+        a, b, lengths, seg_class, two_way, classes = road_segments(gdf)
+        ends = np.empty((2 * len(a), 2), dtype=np.float64)
+        ends[0::2], ends[1::2] = a, b
+        keys = np.round(ends / SNAP_TOLERANCE).astype(np.int64)
+        _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+
+        to_wgs84 = Transformer.from_crs(self.crs.to_string(), "EPSG:4326", always_xy=True)
+        lonlat = np.column_stack(to_wgs84.transform(ends[first, 0], ends[first, 1]))
+        # snap is ground metres, index distances are graph CRS units
+        snap = self.snap * crs_scales(self.crs, lonlat)
+        ids, new_nodes = [], []
+        for i, (lon, lat), limit in zip(first.tolist(), lonlat.tolist(), snap.tolist()):
+            x, y = ends[i].tolist()
+            found = self.graph.index.knearest(x, y, 1)
+            if found and found[0][1] <= limit:
+                ids.append(found[0][0])
+            else:
+                ids.append(self.ps.next_node + len(new_nodes))
+                new_nodes.append([x, y, lon, lat])
+        node = np.array(ids, dtype=np.int64)[inverse.reshape(-1)].reshape(-1, 2)
+
+        edges = []
+        for (u, v), w, c, both in zip(node.tolist(), lengths.tolist(), seg_class.tolist(), two_way.tolist()):
+            if u == v:
+                continue
+            fclass, maxspeed = classes[c]
+            edges.append([u, v, w, fclass, maxspeed])
+            if both:
+                edges.append([v, u, w, fclass, maxspeed])
+            self.touched.extend((u, v))
+        if not edges:
+            raise PatchError("no road segments to add")
+        return {"first_node": self.ps.next_node, "nodes": new_nodes, "edges": edges}
+
+
+def resolve(body, graph, base, ps, graph_crs, snap=1.0):
+    """Turn a request body into a patch in node ids.
+
+    Returns (patch, bbox, local): when local is True only cached routes
+    overlapping bbox can have changed (closures, slower roads); otherwise any
+    route might now have a better alternative."""
+    r = _Resolver(graph, base, ps, graph_crs, float(body.get("snap", snap)))
+    patch = {}
+    local = True
+    if body.get("block"):
+        patch["block"] = [list(p) for item in body["block"]
+                          for p in r.pairs(item, graph, lambda p: _edge_weight(graph, *p) is not None)]
+    if body.get("unblock"):
+        patch["unblock"] = [list(p) for item in body["unblock"]
+                            for p in r.pairs(item, base, lambda p: p in ps.blocked)]
+        local = False
+    if body.get("weights"):
+        weights = []
+        for item in body["weights"]:
+            pairs = r.pairs(item, graph, lambda p: _edge_weight(graph, *p) is not None)
+            if "factor" in item:
+                new = [r.original_length(u, v) * float(item["factor"]) for u, v in pairs]
+            elif "weight" in item:
+                if len({frozenset(p) for p in pairs}) > 1:
+                    raise PatchError("'weight' sets one edge, use 'factor' for a stretch of road")
+                new = [float(item["weight"])] * len(pairs)
+            else:
+                raise PatchError("weights need 'factor' or 'weight'")
+            if any(w < 0 for w in new):
+                raise PatchError("weights must be >= 0")
+            local = local and all(w >= _edge_weight(graph, u, v) for (u, v), w in zip(pairs, new))
+            weights.extend([u, v, w] for (u, v), w in zip(pairs, new))
+        patch["weights"] = weights
+    if body.get("add") or body.get("add_file"):
+        patch["add"] = r.add(body)
+        local = False
+    if not patch:
+        raise PatchError("patch needs block, unblock, weights, add or add_file")
+
+    xy = [graph.coords[n].tolist() for n in r.touched if n < graph.num_nodes]
+    xy += [nd[:2] for nd in patch.get("add", {}).get("nodes", ())]
+    xs, ys = [p[0] for p in xy], [p[1] for p in xy]
+    return patch, [min(xs), min(ys), max(xs), max(ys)], local
+
+
+class PatchLog:
+    """Append-only JSONL journal of patches, shared by every worker on the host
+    and replayed at startup so closures survive a restart."""
+
+    def __init__(self, path, graph_key):
+        self.path = path
+        self.key = graph_key
+        self.offset = 0
+
+    def append(self, patch=None, bbox=None, local=False, reset=False):
+        rec = {"key": self.key, "id": uuid.uuid4().hex, "time": time.time()}
+        if reset:
+            rec["reset"] = True
+        else:
+            rec.update(patch=patch, bbox=bbox, local=local)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(rec, separators=(",", ":")) + "\n")
+        return rec["id"]
+
+    def changed(self):
+        try:
+            return os.path.getsize(self.path) != self.offset
+        except OSError:
+            return False
+
+    def read_new(self):
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self.offset)
+                data = f.read()
+        except OSError:
+            return []
+        # Only whole lines; a partly written last line is picked up next time
+        end = data.rfind(b"\n") + 1
+        self.offset += end
+        out = []
+        for line in data[:end].decode().splitlines():
+            rec = json.loads(line)
+            if rec.get("key") == self.key:
+                out.append(rec)
+        return out
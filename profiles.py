@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# km/h used when a road has no maxspeed tag
+DEFAULT_SPEEDS = {
+    "motorway": 110, "motorway_link": 60,
+    "trunk": 90, "trunk_link": 50,
+    "primary": 70, "primary_link": 40,
+    "secondary": 60, "secondary_link": 40,
+    "tertiary": 50, "tertiary_link": 30,
+    "unclassified": 40, "residential": 30, "living_street": 10, "service": 20,
+    "track": 25, "track_grade1": 30, "track_grade2": 25, "track_grade3": 20,
+    "track_grade4": 15, "track_grade5": 10,
+    "pedestrian": 5, "footway": 5, "path": 5, "steps": 3, "bridleway": 5, "cycleway": 15,
+}
+FALLBACK_SPEED = 30
+
+NON_MOTOR = ["pedestrian", "footway", "path", "steps", "bridleway", "cycleway"]
+
+# metric: distance (metres) or time (seconds)
+# speeds: km/h per fclass, overriding DEFAULT_SPEEDS (maxspeed still wins when tagged)
+# factors: cost multiplier per fclass; avoid: fclasses that cannot be used at all
+PROFILES = {
+    "distance": {"metric": "distance"},
+    "time": {"metric": "time"},
+    "car": {"metric": "time", "avoid": NON_MOTOR,
+            "factors": {"track": 1.5, "track_grade3": 2, "track_grade4": 3, "track_grade5": 4}},
+    "walk": {"metric": "time", "speeds": {c: 5 for c in DEFAULT_SPEEDS}, "use_maxspeed": False,
+             "avoid": ["motorway", "motorway_link", "trunk", "trunk_link"]},
+}
+
+
+def load_profiles(path=None):
+    """Built-in profiles plus any from the JSON file in OSM_PROFILES ({name: spec})."""
+    profiles = dict(PROFILES)
+    path = path or os.environ.get("OSM_PROFILES")
+    if path:
+        with open(path) as f:
+            profiles.update(json.load(f))
+    return profiles
+
+
+def fingerprint(profiles):
+    return hashlib.sha256(json.dumps(profiles, sort_keys=True).encode()).hexdigest()
+
+
+def class_speed(fclass, maxspeed, spec):
+    if maxspeed > 0 and spec.get("use_maxspeed", True):
+        return float(maxspeed)
+    speeds = spec.get("speeds", {})
+    return float(speeds.get(fclass, DEFAULT_SPEEDS.get(fclass, FALLBACK_SPEED)))
+
+
+def class_factors(classes, spec):
+    """Cost per metre for each (fclass, maxspeed) class; inf closes the class."""
+    factors = np.ones(len(classes), dtype=np.float64)
+    avoid = set(spec.get("avoid", ()))
+    extra = spec.get("factors", {})
+    for i, (fclass, maxspeed) in enumerate(classes):
+        if fclass in avoid:
+            factors[i] = np.inf
+            continue
+        if spec.get("metric", "distance") == "time":
+            factors[i] = 3.6 / class_speed(fclass, maxspeed, spec)
+        factors[i] *= extra.get(fclass, 1.0)
+    return factors
+
+
+class Weighting:
+    """Weighted views of one graph, one per profile name, created on first use."""
+
+    def __init__(self, graph, profiles=None):
+        self.graph = graph
+        self.profiles = profiles if profiles is not None else load_profiles()
+        self._views = {}
+
+    def names(self):
+        return sorted(self.profiles)
+
+    def view(self, name):
+        if name not in self.profiles:
+            raise KeyError(name)
+        spec = self.profiles[name]
+        if spec.get("metric", "distance") == "distance" and not spec.get("avoid") and not spec.get("factors"):
+            return self.graph
+        if name not in self._views:
+            self._views[name] = self.graph.weighted(class_factors(self.graph.classes, spec))
+        return self._views[name]
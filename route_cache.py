@@ -0,0 +1,247 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def _encode(value):
+    return json.dumps(value, separators=(",", ":"))
+
+
+def _overlaps(a, b):
+    return not (a[2] < b[0] or a[0] > b[2] or a[3] < b[1] or a[1] > b[3])
+
+
+class LRUCache:
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size=None, bbox=None):
+        if size is None:
+            size = len(_encode(value))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._data[key] = (value, size, bbox)
+            self.bytes += size
+            while len(self._data) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, dropped, _) = self._data.popitem(last=False)
+                self.bytes -= dropped
+                self.evictions += 1
+
+    def invalidate(self, bbox):
+        # Entries stored without a bbox (no path found) are kept
+        with self._lock:
+            stale = [k for k, (_, _, b) in self._data.items() if b is not None and _overlaps(b, bbox)]
+            for k in stale:
+                self.bytes -= self._data.pop(k)[1]
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "entries": len(self._data),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class SqliteCache:
+    """Route cache shared by every worker on the host through one sqlite file.
+
+    Trimming drops the least recently used rows. A hit only writes the access
+    time back when the stored one is older than touch_after seconds, so hot
+    keys cost one write a minute instead of one per read."""
+
+    def __init__(self, path, max_entries=200000, touch_after=60.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.touch_after = touch_after
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._local = threading.local()
+        self._puts = 0
+        with self._conn() as db:
+            cols = [r[1] for r in db.execute("PRAGMA table_info(routes)")]
+            if cols and "minx" not in cols:
+                db.execute("DROP TABLE routes")
+            db.execute("CREATE TABLE IF NOT EXISTS routes "
+                       "(key TEXT PRIMARY KEY, value TEXT NOT NULL, atime REAL NOT NULL, "
+                       "minx REAL, miny REAL, maxx REAL, maxy REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS routes_atime ON routes (atime)")
+
+    def _conn(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5.0)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def get(self, key, with_bbox=False):
+        try:
+            db = self._conn()
+            row = db.execute("SELECT value, atime, minx, miny, maxx, maxy FROM routes WHERE key = ?",
+                             (key,)).fetchone()
+        except sqlite3.Error:
+            row = None
+        if row is None:
+            self.misses += 1
+            return (None, None) if with_bbox else None
+        self.hits += 1
+        now = time.time()
+        if now - row[1] > self.touch_after:
+            try:
+                with db:
+                    db.execute("UPDATE routes SET atime = ? WHERE key = ?", (now, key))
+            except sqlite3.Error:
+                pass
+        value = json.loads(row[0])
+        if with_bbox:
+            return value, (tuple(row[2:]) if row[2] is not None else None)
+        return value
+
+    def put(self, key, value, encoded=None, bbox=None):
+        try:
+            with self._conn() as db:
+                db.execute("INSERT OR REPLACE INTO routes (key, value, atime, minx, miny, maxx, maxy) "
+                           "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (key, encoded or _encode(value), time.time(), *(bbox or (None,) * 4)))
+                self._puts += 1
+                if self._puts % 1000 == 0:
+                    self._trim(db)
+        except sqlite3.Error:
+            pass
+
+    def _trim(self, db):
+        count = db.execute("SELECT COUNT(*) FROM routes").fetchone()[0]
+        extra = count - self.max_entries
+        if extra > 0:
+            db.execute("DELETE FROM routes WHERE key IN "
+                       "(SELECT key FROM routes ORDER BY atime LIMIT ?)", (extra,))
+            self.evictions += extra
+
+    def delete(self, key):
+        try:
+            with self._conn() as db:
+                db.execute("DELETE FROM routes WHERE key = ?", (key,))
+        except sqlite3.Error:
+            pass
+
+    def invalidate(self, bbox):
+        try:
+            with self._conn() as db:
+                return db.execute("DELETE FROM routes WHERE minx IS NOT NULL AND NOT "
+                                  "(maxx < ? OR minx > ? OR maxy < ? OR miny > ?)",
+                                  (bbox[0], bbox[2], bbox[1], bbox[3])).rowcount
+        except sqlite3.Error:
+            return 0
+
+    def clear(self):
+        with self._conn() as db:
+            db.execute("DELETE FROM routes")
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class RouteCache:
+    """In-process LRU in front of an optional shared backend."""
+
+    def __init__(self, local, shared=None, namespace=""):
+        self.local = local
+        self.shared = shared
+        self.namespace = namespace
+        # Per lookup, whichever level answered; local misses include shared hits
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        return self.namespace + _encode(list(key))
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            self.local_hits += 1
+            return value
+        if self.shared is not None:
+            value, bbox = self.shared.get(self._key(key), with_bbox=True)
+            if value is not None:
+                self.shared_hits += 1
+                self.local.put(key, value, bbox=bbox)
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value, bbox=None, shared=True):
+        # bbox = (minx, miny, maxx, maxy) of the result, for invalidate()
+        encoded = _encode(value)
+        self.local.put(key, value, size=len(encoded), bbox=bbox)
+        if shared and self.shared is not None:
+            self.shared.put(self._key(key), value, encoded=encoded, bbox=bbox)
+
+    def discard_shared(self, key):
+        if self.shared is not None:
+            self.shared.delete(self._key(key))
+
+    def invalidate(self, bbox, shared=True):
+        dropped = self.local.invalidate(bbox)
+        if shared and self.shared is not None:
+            dropped += self.shared.invalidate(bbox)
+        return dropped
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def stats(self):
+        out = {"local": self.local.stats(),
+               "total": {"local_hits": self.local_hits, "shared_hits": self.shared_hits, "misses": self.misses}}
+        if self.shared is not None:
+            out["shared"] = self.shared.stats()
+        return out
+
+
+def from_env(default_shared_path, namespace=""):
+    local = LRUCache(max_entries=int(os.environ.get("ROUTE_CACHE_ENTRIES", 10000)),
+                     max_bytes=int(float(os.environ.get("ROUTE_CACHE_MB", 64)) * 1024 * 1024))
+    shared_path = os.environ.get("ROUTE_CACHE_SHARED", default_shared_path)
+    shared = None
+    if shared_path and shared_path.lower() != "off":
+        shared = SqliteCache(shared_path)
+    return RouteCache(local, shared, namespace)
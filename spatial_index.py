@@ -0,0 +1,169 @@
+import heapq
+import math
+
+import numpy as np
+
+NODES_PER_CELL = 4
+
+
+class GridIndex:
+    """Uniform grid bucket index over node coordinates (graph CRS units)."""
+
+    def __init__(self, coords, cell_offsets, cell_nodes, origin, cell_size, nx, ny):
+        self.coords = coords
+        self.cell_offsets = cell_offsets
+        self.cell_nodes = cell_nodes
+        self.x0, self.y0 = origin
+        self.cell_size = cell_size
+        self.nx = nx
+        self.ny = ny
+
+    @classmethod
+    def build(cls, coords, node_ids=None, cell_size=None):
+        if node_ids is None:
+            node_ids = np.arange(len(coords), dtype=np.int32)
+        node_ids = np.asarray(node_ids, dtype=np.int32)
+        pts = coords[node_ids]
+        if len(pts) == 0:
+            x0 = y0 = 0.0
+            w = h = 1.0
+        else:
+            x0, y0 = pts.min(axis=0).tolist()
+            x1, y1 = pts.max(axis=0).tolist()
+            w, h = max(x1 - x0, 1.0), max(y1 - y0, 1.0)
+        if cell_size is None:
+            cell_size = math.sqrt(w * h * NODES_PER_CELL / max(len(pts), 1))
+        nx = int(w // cell_size) + 1
+        ny = int(h // cell_size) + 1
+
+        cx = ((pts[:, 0] - x0) // cell_size).astype(np.int64)
+        cy = ((pts[:, 1] - y0) // cell_size).astype(np.int64)
+        cell = cy * nx + cx
+        order = np.argsort(cell, kind="stable")
+        cell_offsets = np.zeros(nx * ny + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cell, minlength=nx * ny), out=cell_offsets[1:])
+        return cls(coords, cell_offsets, node_ids[order], (x0, y0), float(cell_size), nx, ny)
+
+    def to_arrays(self):
+        return {"index.cell_offsets": self.cell_offsets, "index.cell_nodes": self.cell_nodes}
+
+    def meta(self):
+        return {"origin": [self.x0, self.y0], "cell_size": self.cell_size, "nx": self.nx, "ny": self.ny}
+
+    @classmethod
+    def from_arrays(cls, coords, arrays, meta):
+        return cls(coords, arrays["index.cell_offsets"], arrays["index.cell_nodes"],
+                   tuple(meta["origin"]), meta["cell_size"], meta["nx"], meta["ny"])
+
+    def _cell(self, x, y):
+        cx = min(max(int((x - self.x0) // self.cell_size), 0), self.nx - 1)
+        cy = min(max(int((y - self.y0) // self.cell_size), 0), self.ny - 1)
+        return cx, cy
+
+    def _block(self, cx0, cx1, cy0, cy1):
+        # Cells of one grid row are contiguous in cell_nodes
+        cx0, cx1 = max(cx0, 0), min(cx1, self.nx - 1)
+        cy0, cy1 = max(cy0, 0), min(cy1, self.ny - 1)
+        if cx0 > cx1 or cy0 > cy1:
+            return []
+        parts = []
+        for cy in range(cy0, cy1 + 1):
+            a = self.cell_offsets[cy * self.nx + cx0]
+            b = self.cell_offsets[cy * self.nx + cx1 + 1]
+            if b > a:
+                parts.append(self.cell_nodes[a:b])
+        return parts
+
+    def _ring(self, cx, cy, r):
+        if r == 0:
+            return self._block(cx, cx, cy, cy)
+        parts = self._block(cx - r, cx + r, cy - r, cy - r)
+        parts += self._block(cx - r, cx + r, cy + r, cy + r)
+        parts += self._block(cx - r, cx - r, cy - r + 1, cy + r - 1)
+        parts += self._block(cx + r, cx + r, cy - r + 1, cy + r - 1)
+        return parts
+
+    def knearest(self, x, y, k=1):
+        """Return up to k (node, distance) pairs ordered by distance."""
+        cx, cy = self._cell(x, y)
+        max_r = max(self.nx, self.ny)
+        best = []  # max-heap of (-d2, node)
+        r = 0
+        while r <= max_r:
+            parts = self._ring(cx, cy, r)
+            if parts:
+                ids = np.concatenate(parts)
+                d2 = ((self.coords[ids, 0] - x) ** 2 + (self.coords[ids, 1] - y) ** 2)
+                if len(ids) > k:
+                    top = np.argpartition(d2, k)[:k]
+                    ids, d2 = ids[top], d2[top]
+                for nid, d in zip(ids.tolist(), d2.tolist()):
+                    if len(best) < k:
+                        heapq.heappush(best, (-d, nid))
+                    elif d < -best[0][0]:
+                        heapq.heapreplace(best, (-d, nid))
+            # Anything in ring r+1 is at least r cells away
+            if len(best) >= k and -best[0][0] <= (r * self.cell_size) ** 2:
+                break
+            r += 1
+        return [(nid, math.sqrt(-d)) for d, nid in sorted(best, reverse=True)]
+
+    def nearest(self, x, y):
+        found = self.knearest(x, y, 1)
+        return found[0][0] if found else None
+
+    def within(self, x, y, radius):
+        """Return (node, distance) pairs within radius, ordered by distance."""
+        c0x, c0y = self._cell(x - radius, y - radius)
+        c1x, c1y = self._cell(x + radius, y + radius)
+        parts = self._block(c0x, c1x, c0y, c1y)
+        if not parts:
+            return []
+        ids = np.concatenate(parts)
+        d = np.hypot(self.coords[ids, 0] - x, self.coords[ids, 1] - y)
+        keep = d <= radius
+        ids, d = ids[keep], d[keep]
+        order = np.argsort(d, kind="stable")
+        return list(zip(ids[order].tolist(), d[order].tolist()))
+
+    def nearest_many(self, xs, ys):
+        return [self.nearest(x, y) for x, y in zip(xs, ys)]
+
+
+class OverlayIndex:
+    """A GridIndex with some nodes hidden and a small index of added nodes on top."""
+
+    def __init__(self, base, coords, added_nodes=(), hidden=()):
+        self.base = base
+        self.coords = coords
+        self.hidden = set(int(n) for n in hidden)
+        added = np.asarray(added_nodes, dtype=np.int32)
+        self.extra = GridIndex.build(coords, added) if len(added) else None
+
+    def _base_knearest(self, x, y, k):
+        want = k
+        while True:
+            found = self.base.knearest(x, y, want)
+            kept = [f for f in found if f[0] not in self.hidden]
+            if len(kept) >= k or len(found) < want:
+                return kept[:k]
+            want *= 2
+
+    def knearest(self, x, y, k=1):
+        found = self._base_knearest(x, y, k) if self.hidden else self.base.knearest(x, y, k)
+        if self.extra is not None:
+            found = sorted(found + self.extra.knearest(x, y, k), key=lambda f: f[1])[:k]
+        return found
+
+    def nearest(self, x, y):
+        found = self.knearest(x, y, 1)
+        return found[0][0] if found else None
+
+    def within(self, x, y, radius):
+        found = [f for f in self.base.within(x, y, radius) if f[0] not in self.hidden]
+        if self.extra is not None:
+            found = sorted(found + self.extra.within(x, y, radius), key=lambda f: f[1])
+        return found
+
+    def nearest_many(self, xs, ys):
+        return [self.nearest(x, y) for x, y in zip(xs, ys)]